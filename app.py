@@ -1,19 +1,58 @@
-# pylint: disable=R0903, E1101
+# pylint: disable=R0903, E1101, C0302
 
 """
 This module defines a simple Flask REST API for managing student records.
 It uses SQLAlchemy for database operations and Flask-Migrate for handling migrations.
 """
 
+import base64
+import csv
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import operator
 import os
+import re
 import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String
+import click
+import psycopg2
+
+from flask import (Flask, Response, g, has_request_context, jsonify, make_response, request,
+                   stream_with_context, url_for)
+from flask.cli import AppGroup
+from flask.json import JSONEncoder, dumps as json_dumps
+from sqlalchemy import (DDL, BigInteger, Column, DateTime, Index, Integer, LargeBinary,
+                        SmallInteger, String, Text, event, func, select, text, tuple_)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import (DataError, DBAPIError, IntegrityError, OperationalError,
+                            SQLAlchemyError)
+from sqlalchemy.sql import Select
 from flask_migrate import Migrate
 from dotenv import load_dotenv
 
+import response_compression
+from group_commit import GroupCommitter
+from pool_metrics import InstrumentedQueuePool
+from prepared_statements import PreparedStatements
+from read_routing import ReplicaRouter, RoutingSQLAlchemy
+from sharding import ShardRouter, in_ranges
+from transient_errors import RetryPolicy, classify
+from write_behind import WriteBehindLog
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
@@ -31,17 +70,1390 @@ if not DATABASE_URL:
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# Initialize SQLAlchemy and Migrate
-db = SQLAlchemy(app)
+# Set when DATABASE_URL points at a transaction-pooling proxy such as PgBouncer.
+# Consecutive transactions may then run on different server connections, so
+# nothing may rely on session state, and the proxy does the pooling.
+app.config['DB_TRANSACTION_POOLING'] = os.getenv("DB_TRANSACTION_POOLING", "0") == "1"
+
+# Connection pool of each worker process: it keeps up to DB_POOL_SIZE connections
+# open, opens up to DB_MAX_OVERFLOW more under load, and a request waits at most
+# DB_POOL_TIMEOUT seconds for a free one. DB_POOL_RECYCLE replaces connections
+# older than that many seconds (-1 never does), DB_POOL_PRE_PING=1 tests each
+# connection before handing it out, and DB_POOL_USE_LIFO=1 reuses the most recent
+# one so idle extras can time out. A DB_POOL_SIZE of 0, the default under
+# transaction pooling, opens a connection per checkout instead.
+# SQLALCHEMY_ENGINE_OPTIONS, a JSON object, overrides any engine option.
+DB_POOL_SIZE = int(os.getenv(
+    "DB_POOL_SIZE", "0" if app.config['DB_TRANSACTION_POOLING'] else "5"))
+if DB_POOL_SIZE:
+    POOL_OPTIONS = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_use_lifo": os.getenv("DB_POOL_USE_LIFO", "0") == "1",
+    }
+else:
+    POOL_OPTIONS = {"poolclass": NullPool}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    **POOL_OPTIONS,
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "0") == "1",
+    **json.loads(os.getenv("SQLALCHEMY_ENGINE_OPTIONS", "{}")),
+}
+
+# Optional comma separated read replicas. GET requests are served by one of them,
+# picked "round_robin" or "least_loaded" (fewest connections in use), unless it
+# has not yet replayed the client's X-Consistency-Token
+READ_DATABASE_URLS = [url.strip() for url in os.getenv("READ_DATABASE_URLS", "").split(",")
+                      if url.strip()]
+app.config['SQLALCHEMY_BINDS'] = {
+    f"replica{index}": url for index, url in enumerate(READ_DATABASE_URLS)}
+app.config['READ_ROUTING'] = os.getenv("READ_ROUTING", "round_robin")
+
+# Optional comma separated shard databases. Students are spread over them by id
+# range, as recorded in the shard map of the main database. Shards lease ranges
+# of SHARD_RANGE_SIZE ids for new rows, workers cache the map for SHARD_MAP_TTL
+# seconds, and listings query all shards on SHARD_FANOUT_WORKERS threads (0 for
+# four per shard).
+SHARD_DATABASE_URLS = [url.strip() for url in os.getenv("SHARD_DATABASE_URLS", "").split(",")
+                       if url.strip()]
+app.config['SQLALCHEMY_BINDS'].update(
+    {f"shard{index}": url for index, url in enumerate(SHARD_DATABASE_URLS)})
+app.config['SHARD_RANGE_SIZE'] = int(os.getenv("SHARD_RANGE_SIZE", "1000000"))
+app.config['SHARD_MAP_TTL'] = float(os.getenv("SHARD_MAP_TTL", "1"))
+app.config['SHARD_FANOUT_WORKERS'] = int(os.getenv("SHARD_FANOUT_WORKERS", "0"))
+
+# Page sizes for the student listing
+app.config['STUDENTS_PAGE_SIZE'] = int(os.getenv("STUDENTS_PAGE_SIZE", "100"))
+app.config['STUDENTS_MAX_PAGE_SIZE'] = int(os.getenv("STUDENTS_MAX_PAGE_SIZE", "1000"))
+
+# Rows fetched per round trip from the server-side cursor when streaming
+app.config['STUDENTS_STREAM_BATCH_SIZE'] = int(os.getenv("STUDENTS_STREAM_BATCH_SIZE", "1000"))
+
+# "orm" loads full Student entities for listings, "core" selects plain rows; full
+# rows read by prepared statements are plain rows either way
+app.config['STUDENTS_READ_PATH'] = os.getenv("STUDENTS_READ_PATH", "orm")
+
+# Largest batch accepted by POST /students/bulk, and rows per INSERT statement
+app.config['STUDENTS_BULK_MAX_ITEMS'] = int(os.getenv("STUDENTS_BULK_MAX_ITEMS", "10000"))
+app.config['STUDENTS_BULK_INSERT_CHUNK'] = int(os.getenv("STUDENTS_BULK_INSERT_CHUNK", "1000"))
+
+# Opt-in group commit: single creates in a worker share one transaction, flushed
+# after at most MAX_DELAY_MS milliseconds or MAX_BATCH rows
+app.config['STUDENTS_GROUP_COMMIT'] = os.getenv("STUDENTS_GROUP_COMMIT", "0") == "1"
+app.config['STUDENTS_GROUP_COMMIT_MAX_DELAY_MS'] = float(
+    os.getenv("STUDENTS_GROUP_COMMIT_MAX_DELAY_MS", "5"))
+app.config['STUDENTS_GROUP_COMMIT_MAX_BATCH'] = int(
+    os.getenv("STUDENTS_GROUP_COMMIT_MAX_BATCH", "100"))
+
+# How long stored Idempotency-Key responses are replayed, and how often and in
+# what batch size expired keys are swept (an interval of 0 disables the sweeper)
+app.config['IDEMPOTENCY_KEY_TTL'] = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+app.config['IDEMPOTENCY_SWEEP_INTERVAL'] = int(os.getenv("IDEMPOTENCY_SWEEP_INTERVAL", "300"))
+app.config['IDEMPOTENCY_SWEEP_BATCH'] = int(os.getenv("IDEMPOTENCY_SWEEP_BATCH", "1000"))
+
+# Opt-in write-behind: creates are appended to a local log, acknowledged with 202,
+# and applied to the database in the background
+app.config['STUDENTS_WRITE_BEHIND'] = os.getenv("STUDENTS_WRITE_BEHIND", "0") == "1"
+app.config['WRITE_BEHIND_DIR'] = os.getenv(
+    "WRITE_BEHIND_DIR", os.path.join(app.instance_path, "write-behind", socket.gethostname()))
+app.config['WRITE_BEHIND_FSYNC_MS'] = float(os.getenv("WRITE_BEHIND_FSYNC_MS", "5"))
+app.config['WRITE_BEHIND_BATCH'] = int(os.getenv("WRITE_BEHIND_BATCH", "1000"))
+
+# Most rows PATCH /students or DELETE /students may change unless max_affected says otherwise
+app.config['STUDENTS_MAX_AFFECTED'] = int(os.getenv("STUDENTS_MAX_AFFECTED", "10000"))
+
+# Latency budgets in milliseconds of single reads, single writes, bulk writes and
+# imports (0 for none). Every transaction of a request runs with a statement_timeout
+# of what is left of its budget, which X-Request-Deadline can only shorten. Imports
+# have none by default, as a COPY takes as long as the file it loads.
+app.config['READ_BUDGET_MS'] = int(os.getenv("READ_BUDGET_MS", "2000"))
+app.config['WRITE_BUDGET_MS'] = int(os.getenv("WRITE_BUDGET_MS", "5000"))
+app.config['BULK_BUDGET_MS'] = int(os.getenv("BULK_BUDGET_MS", "60000"))
+app.config['IMPORT_BUDGET_MS'] = int(os.getenv("IMPORT_BUDGET_MS", "0"))
+
+# Attempts (the first included) at a unit of work that hit a transient database
+# error, and the base and cap in milliseconds of the jittered backoff between them
+app.config['DB_RETRY_ATTEMPTS'] = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+app.config['DB_RETRY_BASE_MS'] = float(os.getenv("DB_RETRY_BASE_MS", "50"))
+app.config['DB_RETRY_MAX_MS'] = float(os.getenv("DB_RETRY_MAX_MS", "1000"))
+
+# Run the hottest student statements as server-side prepared statements, which
+# live in the server session and so are never used under transaction pooling
+app.config['PREPARED_STATEMENTS'] = os.getenv("PREPARED_STATEMENTS", "1") == "1" \
+    and not app.config['DB_TRANSACTION_POOLING']
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+CSV_MIMETYPE = "text/csv"
+
+# Characters that the stdlib encoder escapes while ensure_ascii is on
+NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+def escape_non_ascii(match):
+    """
+    The \\uXXXX escape, as a surrogate pair beyond the BMP, of a matched character.
+    """
+    code = ord(match.group())
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+    code -= 0x10000
+    return f"\\u{0xd800 | code >> 10:04x}\\u{0xdc00 | code & 0x3ff:04x}"
+
+class FastJSONEncoder(JSONEncoder):
+    """
+    JSON encoder that hands compact output to orjson when it is installed.
+
+    Indented output and values orjson cannot encode are left to the stdlib
+    encoder. Strings, integers and keys come out byte-identical to it, non-ASCII
+    text included, which is escaped after the fact while JSON_AS_ASCII is on.
+    Floats keep orjson's shortest form, 1e16 rather than 1e+16, and NaN and
+    Infinity, which are not JSON, become null.
+    """
+    def encode(self, o):
+        if orjson is None or self.indent is not None or (
+                self.item_separator, self.key_separator) != (",", ":"):
+            return super().encode(o)
+
+        option = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                  | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_SUBCLASS)
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            encoded = orjson.dumps(o, default=self.default, option=option).decode()
+        except orjson.JSONEncodeError:
+            return super().encode(o)
+        # Outside string literals orjson only writes ASCII, so escaping it all is safe
+        if self.ensure_ascii and (not encoded.isascii() or "\x7f" in encoded):
+            encoded = NON_ASCII.sub(escape_non_ascii, encoded)
+        return encoded
+
+# "auto" serializes responses with orjson when available, "stdlib" never does
+if os.getenv("JSON_SERIALIZER", "auto") != "stdlib":
+    app.json_encoder = FastJSONEncoder
+
+# Response compression, skipped for bodies smaller than COMPRESS_MIN_SIZE bytes
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+app.config['COMPRESS_CACHE_SIZE'] = int(os.getenv("COMPRESS_CACHE_SIZE", "128"))
+
+# Initialize SQLAlchemy, Migrate and compression
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
+response_compression.init_app(app)
 
 class Student(db.Model):
     """
     Student model represents a student record in the database.
     """
+    # Serve filtered and sorted keyset pages (ordered by the column, then id) and
+    # name prefix searches from B-tree indexes.
+    __table_args__ = (
+        Index("ix_student_age_id", "age", "id"),
+        Index("ix_student_name_id", "name", "id"),
+        Index("ix_student_name_pattern", "name", postgresql_ops={"name": "varchar_pattern_ops"}),
+    )
+
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
     age = Column(Integer, nullable=False)
+    # Natural key assigned by the upstream student information system
+    external_id = Column(String(64), index=True, unique=True)
+    # Bumped by every write to the row and served as its strong ETag
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+class TableVersion(db.Model):
+    """
+    One slot of the change counter of a table, bumped by a trigger on every write to it.
+
+    The counter is the sum of the table's slots. Each write bumps a random slot, so
+    concurrent writers rarely wait for each other's row lock until they commit.
+    """
+    __tablename__ = "table_versions"
+    name = Column(String(64), primary_key=True)
+    slot = Column(SmallInteger, primary_key=True, default=0, server_default="0")
+    version = Column(BigInteger, nullable=False, default=0)
+
+class IdempotencyKey(db.Model):
+    """
+    Response stored for an Idempotency-Key, replayed when the request is retried.
+    """
+    __tablename__ = "idempotency_keys"
+    key_hash = Column(LargeBinary(32), primary_key=True)
+    status = Column(SmallInteger, nullable=False)
+    body = Column(Text, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class ShardRange(db.Model):
+    """
+    Range of student ids, from low up to but not including high, stored on a shard.
+    """
+    __tablename__ = "shard_ranges"
+    low = Column(BigInteger, primary_key=True)
+    high = Column(BigInteger, nullable=False)
+    shard = Column(String(64), nullable=False)
+
+# Statement-level triggers that bump one of the 16 slots of the table's counter once
+# per write statement that changed rows. Each event hands its changed rows over as
+# the changed_rows transition table, which TRUNCATE cannot. The same DDL is applied
+# by the migration; this installs it for create_all().
+BUMP_TABLE_VERSION_FUNCTION = DDL("""
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'TRUNCATE' THEN
+        IF NOT EXISTS (SELECT FROM changed_rows) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    INSERT INTO table_versions (name, slot, version)
+    VALUES (TG_TABLE_NAME, floor(random() * 16)::smallint, 1)
+    ON CONFLICT (name, slot) DO UPDATE SET version = table_versions.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+""")
+BUMP_STUDENT_VERSION_TRIGGER = DDL("""
+CREATE TRIGGER %(table)s_bump_version_insert
+AFTER INSERT ON %(table)s REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+CREATE TRIGGER %(table)s_bump_version_update
+AFTER UPDATE ON %(table)s REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+CREATE TRIGGER %(table)s_bump_version_delete
+AFTER DELETE ON %(table)s REFERENCING OLD TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+CREATE TRIGGER %(table)s_bump_version_truncate
+AFTER TRUNCATE ON %(table)s
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+""")
+event.listen(Student.__table__, "after_create",
+             BUMP_TABLE_VERSION_FUNCTION.execute_if(dialect="postgresql"))
+event.listen(Student.__table__, "after_create",
+             BUMP_STUDENT_VERSION_TRIGGER.execute_if(dialect="postgresql"))
+
+# Serves sort=name on the shards, which order names in the "C" collation
+SHARD_NAME_INDEX = DDL(
+    'CREATE INDEX IF NOT EXISTS ix_student_name_c_id ON student (name COLLATE "C", id)')
+
+STUDENT_FIELDS = ("id", "name", "age", "external_id", "version")
+SORT_KEYS = ("id", "name", "age")
+FILTER_PARAMS = ("age", "age_min", "age_max", "name", "name_prefix")
+# Query parameters of filtered PATCH and DELETE besides the filters
+FILTERED_WRITE_PARAMS = ("all", "dry_run", "max_affected", "batch_size")
+
+STUDENT_COLUMNS = ", ".join(STUDENT_FIELDS)
+prepared_statements = PreparedStatements({
+    "student_by_id": f"SELECT {STUDENT_COLUMNS} FROM student WHERE id = $1",
+    "student_page_first": f"SELECT {STUDENT_COLUMNS} FROM student ORDER BY id LIMIT $1",
+    "student_page_after":
+        f"SELECT {STUDENT_COLUMNS} FROM student WHERE id > $1 ORDER BY id LIMIT $2",
+    "student_insert":
+        f"INSERT INTO student (name, age) VALUES ($1, $2) RETURNING {STUDENT_COLUMNS}",
+})
+
+@event.listens_for(Engine, "connect")
+def prepare_student_statements(dbapi_connection, connection_record):
+    """
+    Prepare the hot student statements on every new Postgres connection.
+    """
+    if app.config['PREPARED_STATEMENTS'] and isinstance(
+            dbapi_connection, psycopg2.extensions.connection):
+        prepared_statements.prepare_all(dbapi_connection, connection_record)
+
+def use_prepared_statements():
+    """
+    Whether the hot statements should run as prepared statements.
+    """
+    return app.config['PREPARED_STATEMENTS'] and db.engine.dialect.name == "postgresql"
+
+def execute_prepared(name, *params):
+    """
+    Run a prepared student statement in the current session and return its rows.
+    """
+    connection = db.session.connection()  # pylint: disable=no-member
+    return prepared_statements.execute(connection, name, *params).all()
+
+def table_version(table):
+    """
+    Current change counter of a table, or None when the database has no trigger for
+    it, or the table is sharded and every shard counts its own changes.
+    """
+    if db.engine.dialect.name != "postgresql" or shard_router.shards:
+        return None
+    version = db.session.query(  # pylint: disable=no-member
+        func.sum(TableVersion.version)).filter(TableVersion.name == table.name).scalar()
+    return int(version or 0)
+
+def conditional(table):
+    """
+    Answer If-None-Match with 304 Not Modified when the table has not changed.
+
+    The version is read before the view runs its queries, so a concurrent write can
+    only make the ETag older than the body, which costs the client a refetch, never
+    a stale 304.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            version = table_version(table)
+            if version is None:
+                return view(*args, **kwargs)
+
+            etag = f"{table.name}-{version}"
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.vary.add("Accept")
+            return response
+        return wrapper
+    return decorator
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request has used up its latency budget before its next transaction.
+    """
+
+def time_budget(config_key):
+    """
+    Give a route the latency budget configured under config_key.
+
+    A shorter `X-Request-Deadline` header, the milliseconds the caller is still
+    willing to wait, takes precedence. A request whose budget is already spent
+    is refused with 503 before touching the database.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            budgets = [app.config[config_key] / 1000] if app.config[config_key] else []
+            try:
+                if "X-Request-Deadline" in request.headers:
+                    budgets.append(int(request.headers["X-Request-Deadline"]) / 1000)
+            except ValueError:
+                return jsonify({"error": "X-Request-Deadline must be milliseconds"}), 400
+            if budgets:
+                g.deadline = time.monotonic() + min(budgets)
+            if budgets and min(budgets) <= 0:
+                raise DeadlineExceeded()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                # The budget covers the view only; the after_request hooks still read
+                # the consistency token of a write the view has already committed
+                g.pop("deadline", None)
+        return wrapper
+    return decorator
+
+@event.listens_for(db.session, "after_begin")
+def set_statement_timeout(_session, _transaction, connection):
+    """
+    Bound every statement of a transaction by what is left of the request's budget.
+    """
+    deadline = g.get("deadline") if has_request_context() else None
+    if deadline is not None:
+        limit_statement_time(connection, deadline)
+
+def limit_statement_time(connection, deadline):
+    """
+    Bound the statements of the connection's transaction by the time left until deadline.
+    """
+    remaining_ms = int((deadline - time.monotonic()) * 1000)
+    if remaining_ms <= 0:
+        raise DeadlineExceeded()
+    connection.execute(text(f"SET LOCAL statement_timeout = {remaining_ms}"))
+
+retry_policy = RetryPolicy(
+    attempts=app.config['DB_RETRY_ATTEMPTS'],
+    base_delay=app.config['DB_RETRY_BASE_MS'] / 1000,
+    max_delay=app.config['DB_RETRY_MAX_MS'] / 1000)
+
+def retry_transient(idempotent=False):
+    """
+    Run a route again, after a jittered backoff, when it fails with a transient
+    database error and running it again cannot apply its writes twice.
+
+    That is always the case for idempotent routes; idempotent may also be a
+    function deciding it per request. Other routes are retried only when no
+    commit of theirs can have taken effect: a lost connection must have struck
+    before any commit started, a serialization failure or deadlock before any
+    commit finished. Retries stop after DB_RETRY_ATTEMPTS attempts or when the
+    backoff would run past the request's deadline.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            kind = None
+            for retry in itertools.count():
+                g.commits = {"started": 0, "finished": 0}
+                try:
+                    response = view(*args, **kwargs)
+                except DBAPIError as exc:
+                    kind = classify(exc)
+                    if kind is None:
+                        raise
+                    db.session.rollback()  # pylint: disable=no-member
+                    delay = retry_policy.delay(retry)
+                    if retry + 1 >= retry_policy.attempts or not retry_is_safe(
+                            kind, idempotent) or time.monotonic() + delay >= g.get(
+                                "deadline", float("inf")):
+                        retry_policy.record(kind, "given_up")
+                        raise
+                    retry_policy.record(kind, "retried", delay)
+                    time.sleep(delay)
+                    continue
+                if kind is not None:
+                    retry_policy.record(kind, "recovered")
+                return response
+        return wrapper
+    return decorator
+
+def retry_is_safe(kind, idempotent):
+    """
+    Whether the attempt that just failed with a kind of transient error may be repeated.
+    """
+    if idempotent is True or callable(idempotent) and idempotent():
+        return True
+    if kind == "connection":
+        return g.commits["started"] == 0
+    return g.commits["finished"] == 0
+
+@event.listens_for(db.session, "before_commit")
+def count_commit_started(_session):
+    """
+    Note that the current attempt of a retried route started committing.
+    """
+    if has_request_context() and "commits" in g:
+        g.commits["started"] += 1
+
+@event.listens_for(db.session, "after_commit")
+def count_commit_finished(_session):
+    """
+    Note that the current attempt of a retried route committed.
+    """
+    if has_request_context() and "commits" in g:
+        g.commits["finished"] += 1
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(_exc):
+    """
+    Refuse a request whose budget ran out before its queries could start.
+    """
+    response = jsonify({"error": "Request deadline exceeded"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+@app.errorhandler(OperationalError)
+@app.errorhandler(psycopg2.errors.QueryCanceled)
+def database_unavailable(exc):
+    """
+    Answer 504 when Postgres cancelled a statement that ran past the budget, and
+    503 when a transient error outlasted the retries.
+    """
+    if isinstance(getattr(exc, "orig", exc), psycopg2.errors.QueryCanceled):
+        db.session.rollback()  # pylint: disable=no-member
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    if classify(exc) is None:
+        raise exc
+    db.session.rollback()  # pylint: disable=no-member
+    response = jsonify({"error": "Database temporarily unavailable"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+def student_to_dict(student, fields=STUDENT_FIELDS):
+    """
+    Serialize a Student, or a row holding some of its columns, into a dict.
+    """
+    return {field: getattr(student, field) for field in fields}
+
+# Range of the Postgres integer columns
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+def is_int(value):
+    """
+    Whether value is an integer (not a bool) that fits a Postgres integer column.
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and INT_MIN <= value <= INT_MAX
+
+def student_error(data):
+    """
+    Describe what is wrong with a student payload, or return None if it is valid.
+    """
+    if not isinstance(data, dict):
+        return "Student must be an object"
+    name = data.get("name")
+    age = data.get("age")
+    if not name or age is None:
+        return "Name and age are required"
+    if not isinstance(name, str) or len(name) > 100:
+        return "Name must be a string of at most 100 characters"
+    if not is_int(age):
+        return f"Age must be an integer from {INT_MIN} to {INT_MAX}"
+    return None
+
+def insert_students(rows):
+    """
+    Insert rows with multi-row INSERT ... RETURNING statements, without committing.
+
+    Returns the persisted students, with their generated ids and server defaults,
+    as dicts in the order of rows. A single name and age runs the prepared insert.
+    """
+    if len(rows) == 1 and rows[0].keys() == {"name", "age"} and use_prepared_statements():
+        return [student_to_dict(row) for row in execute_prepared(
+            "student_insert", rows[0]["name"], rows[0]["age"])]
+    table = Student.__table__
+    chunk = app.config['STUDENTS_BULK_INSERT_CHUNK']
+    students = []
+    for start in range(0, len(rows), chunk):
+        statement = table.insert().values(rows[start:start + chunk]).returning(*table.c)
+        students.extend(student_to_dict(row)
+                        for row in db.session.execute(statement))  # pylint: disable=no-member
+    return students
+
+def flush_student_batch(rows):
+    """
+    Insert rows collected by the group committer in one transaction.
+
+    If the database rejects a row, each row is retried in its own transaction so a
+    bad row only fails the request that sent it. Any other error, such as a lost
+    connection whose commit may have gone through, fails every row still unwritten
+    rather than inserting it again.
+    """
+    with app.app_context():
+        try:
+            students = insert_students(rows)
+            db.session.commit()  # pylint: disable=no-member
+            return students
+        except (DataError, IntegrityError):
+            db.session.rollback()  # pylint: disable=no-member
+
+        results = []
+        for index, row in enumerate(rows):
+            try:
+                results.extend(insert_students([row]))
+                db.session.commit()  # pylint: disable=no-member
+            except (DataError, IntegrityError) as exc:
+                db.session.rollback()  # pylint: disable=no-member
+                results.append(exc)
+            except SQLAlchemyError as exc:
+                db.session.rollback()  # pylint: disable=no-member
+                return results + [exc] * (len(rows) - index)
+        return results
+
+group_committer = GroupCommitter(
+    flush_student_batch,
+    max_batch=app.config['STUDENTS_GROUP_COMMIT_MAX_BATCH'],
+    max_delay=app.config['STUDENTS_GROUP_COMMIT_MAX_DELAY_MS'] / 1000)
+
+def stored_response(key_hash):
+    """
+    The unexpired response stored for an idempotency key, or None.
+    """
+    stored = IdempotencyKey.query.filter(
+        IdempotencyKey.key_hash == key_hash, IdempotencyKey.expires_at > func.now()).first()
+    if stored is None:
+        return None
+    response = app.response_class(stored.body, status=stored.status, mimetype="application/json")
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+def store_response(key_hash, status, payload):
+    """
+    Record the response for an idempotency key in the current transaction.
+
+    Returns False when a live response is already stored for the key, which means
+    a concurrent request with the same key committed first.
+    """
+    table = IdempotencyKey.__table__
+    values = {
+        "key_hash": key_hash,
+        "status": status,
+        "body": json_dumps(payload, separators=(",", ":")),
+        "expires_at": datetime.now(timezone.utc)
+                      + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL']),
+    }
+    statement = pg_insert(table).values(values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.key_hash],
+        set_={k: statement.excluded[k] for k in ("status", "body", "expires_at")},
+        where=table.c.expires_at <= func.now(),
+    ).returning(table.c.key_hash)
+    return db.session.execute(statement).first() is not None  # pylint: disable=no-member
+
+def sweep_idempotency_keys():
+    """
+    Delete expired idempotency keys, one committed batch at a time.
+
+    Returns the number of keys deleted.
+    """
+    table = IdempotencyKey.__table__
+    batch_size = app.config['IDEMPOTENCY_SWEEP_BATCH']
+    expired = select(table.c.key_hash).where(table.c.expires_at <= func.now()).limit(
+        batch_size).with_for_update(skip_locked=True)
+    deleted = 0
+    while True:
+        count = db.session.execute(  # pylint: disable=no-member
+            table.delete().where(table.c.key_hash.in_(expired))).rowcount
+        db.session.commit()  # pylint: disable=no-member
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def run_idempotency_sweeper():
+    """
+    Sweep expired idempotency keys every IDEMPOTENCY_SWEEP_INTERVAL seconds.
+    """
+    while True:
+        time.sleep(app.config['IDEMPOTENCY_SWEEP_INTERVAL'])
+        with app.app_context():
+            try:
+                sweep_idempotency_keys()
+            except SQLAlchemyError:
+                db.session.rollback()  # pylint: disable=no-member
+                app.logger.exception("Sweeping idempotency keys failed")
+
+@app.before_first_request
+def start_idempotency_sweeper():
+    """
+    Start the idempotency key sweeper in this worker.
+    """
+    if app.config['IDEMPOTENCY_SWEEP_INTERVAL'] > 0:
+        threading.Thread(target=run_idempotency_sweeper, name="idempotency-sweeper",
+                         daemon=True).start()
+
+def write_behind_key(tracking_id):
+    """
+    Idempotency key under which the outcome of a write-behind create is stored.
+    """
+    return hashlib.sha256(f"write-behind:{tracking_id}".encode()).digest()
+
+def store_outcomes(outcomes):
+    """
+    Store write-behind outcomes as idempotency responses, skipping ones already stored.
+
+    outcomes maps tracking ids to (status, payload) pairs.
+    """
+    table = IdempotencyKey.__table__
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+    rows = [{"key_hash": write_behind_key(tracking_id), "status": status,
+             "body": json_dumps(payload, separators=(",", ":")), "expires_at": expires_at}
+            for tracking_id, (status, payload) in outcomes.items()]
+    db.session.execute(  # pylint: disable=no-member
+        pg_insert(table).values(rows).on_conflict_do_nothing(index_elements=[table.c.key_hash]))
+
+def apply_write_behind(batch):
+    """
+    Insert a batch of queued creates in one transaction.
+
+    Creates whose outcome is already stored were applied before a crash and are
+    skipped. If a row is rejected by the database the batch is retried row by row
+    and the rejected rows are recorded as failed.
+    """
+    with app.app_context():
+        session = db.session  # pylint: disable=no-member
+        applied = set(session.execute(select(IdempotencyKey.key_hash).where(
+            IdempotencyKey.key_hash.in_([write_behind_key(t) for t, _ in batch]))).scalars())
+        batch = [(t, item) for t, item in batch if write_behind_key(t) not in applied]
+        if not batch:
+            return
+        try:
+            students = insert_students([item for _, item in batch])
+            store_outcomes({t: (201, {"status": "applied", "id": student["id"]})
+                            for (t, _), student in zip(batch, students)})
+            session.commit()
+            return
+        except (DataError, IntegrityError):
+            session.rollback()
+
+        for tracking_id, item in batch:
+            try:
+                outcome = (201, {"status": "applied", "id": insert_students([item])[0]["id"]})
+            except (DataError, IntegrityError) as exc:
+                session.rollback()
+                outcome = (422, {"status": "failed", "error": str(exc.orig).splitlines()[0]})
+            store_outcomes({tracking_id: outcome})
+            session.commit()
+
+write_behind_log = WriteBehindLog(
+    app.config['WRITE_BEHIND_DIR'], apply_write_behind,
+    fsync_interval=app.config['WRITE_BEHIND_FSYNC_MS'] / 1000,
+    batch_size=app.config['WRITE_BEHIND_BATCH'])
+
+@app.before_first_request
+def start_write_behind():
+    """
+    Replay writes left unapplied by a previous run of this worker.
+    """
+    if app.config['STUDENTS_WRITE_BEHIND']:
+        write_behind_log.start()
+
+def upsert_students(rows):
+    """
+    Insert or update rows by external_id, without committing.
+
+    Each chunk is one INSERT ... ON CONFLICT DO UPDATE statement whose update only
+    touches rows whose values differ, so unchanged students are not rewritten.
+    Returns the number of inserted, updated and unchanged students.
+    """
+    table = Student.__table__
+    chunk = app.config['STUDENTS_BULK_INSERT_CHUNK']
+    inserted = updated = 0
+    for start in range(0, len(rows), chunk):
+        statement = pg_insert(table).values(rows[start:start + chunk])
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.external_id],
+            set_={"name": excluded.name, "age": excluded.age,
+                  "version": table.c.version + 1},
+            where=tuple_(table.c.name, table.c.age).is_distinct_from(
+                tuple_(excluded.name, excluded.age)),
+        ).returning(text("xmax = 0"))
+        for (was_inserted,) in db.session.execute(statement):  # pylint: disable=no-member
+            if was_inserted:
+                inserted += 1
+            else:
+                updated += 1
+    return inserted, updated, len(rows) - inserted - updated
+
+def requested_changes(data):
+    """
+    Parse a bulk PATCH body of the form {"set": {...}, "increment": {...}} into
+    column values for an UPDATE.
+    """
+    if not isinstance(data, dict) or not data or not set(data) <= {"set", "increment"} or not all(
+            isinstance(value, dict) for value in data.values()):
+        raise ValueError("Body must have a set or increment object")
+    table = Student.__table__
+    changes = {}
+    for field, value in data.get("set", {}).items():
+        if field == "name" and isinstance(value, str) and 0 < len(value) <= 100:
+            changes[field] = value
+        elif field == "age" and is_int(value):
+            changes[field] = value
+        else:
+            raise ValueError(f"Cannot set {field} to {value!r}")
+    for field, value in data.get("increment", {}).items():
+        if field != "age" or not is_int(value):
+            raise ValueError(f"Cannot increment {field} by {value!r}")
+        if field in changes:
+            raise ValueError(f"Cannot both set and increment {field}")
+        changes[field] = table.c[field] + value
+    if not changes:
+        raise ValueError("Nothing to change")
+    return changes
+
+def filtered_write(build, verb):
+    """
+    Run a set-based UPDATE or DELETE over the students matched by the filter
+    query parameters, never loading the rows into Python.
+
+    build(clauses) returns the statement restricted by the given WHERE clauses.
+    `dry_run=1` only counts the matching rows. More than `max_affected` matches
+    aborts the write. With `batch_size` the rows are written in chunks keyed on
+    id, each committed on its own, instead of in one statement.
+    """
+    try:
+        # A mistyped filter must not widen a destructive write
+        unknown = set(request.args) - set(FILTER_PARAMS) - set(FILTERED_WRITE_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown query parameters: {', '.join(sorted(unknown))}")
+        filters = requested_filters()
+        if not filters and request.args.get("all") != "1":
+            raise ValueError("A filter, or all=1, is required")
+        max_affected = int(request.args.get("max_affected", app.config['STUDENTS_MAX_AFFECTED']))
+        batch_size = int(request.args.get("batch_size", "0"))
+        # Anything but an explicit dry run would go on to write
+        dry_run = request.args.get("dry_run", "0")
+        if dry_run not in ("0", "1"):
+            raise ValueError("dry_run must be 0 or 1")
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    session = db.session  # pylint: disable=no-member
+    if dry_run == "1":
+        matched = session.execute(select(func.count(Student.id)).where(*filters)).scalar()
+        return jsonify({"matched": matched})
+
+    # Count no further than the limit before writing, so an oversized filter is
+    # refused without locking or writing a single row
+    too_many = {"error": f"More than {max_affected} students match"}
+    capped = select(Student.id).where(*filters).limit(max_affected + 1).subquery()
+    matched = session.execute(select(func.count()).select_from(capped)).scalar()
+    if matched > max_affected:
+        return jsonify(too_many), 409
+
+    if not matched:
+        session.rollback()
+        total, complete = 0, True
+    elif batch_size > 0:
+        total, complete = write_in_batches(build, filters, batch_size, max_affected)
+    else:
+        total, complete = write_at_once(build, filters, max_affected)
+    if not complete:
+        return jsonify(dict(too_many, **{verb: total})), 409
+    return jsonify({verb: total})
+
+def write_at_once(build, filters, max_affected):
+    """
+    Apply a filtered write in one statement, committed unless it wrote more than
+    max_affected rows.
+
+    Returns the number of rows written and whether every matching row was written.
+    """
+    session = db.session  # pylint: disable=no-member
+    count = session.execute(build(filters)).rowcount
+    # Rows inserted since the count can still push the write over the limit
+    if count > max_affected:
+        session.rollback()
+        return 0, False
+    session.commit()
+    return count, True
+
+def write_in_batches(build, filters, batch_size, max_affected):
+    """
+    Apply a filtered write in chunks of batch_size ids, committing each chunk, and
+    stop after max_affected rows.
+
+    Returns the number of rows written and whether every matching row was written.
+    """
+    session = db.session  # pylint: disable=no-member
+    total, last_id = 0, None
+    while True:
+        remaining = select(Student.id).where(*filters).order_by(Student.id)
+        if last_id is not None:
+            remaining = remaining.where(Student.id > last_id)
+        # Rows inserted since the count was taken must not take the total past the limit
+        size = min(batch_size, max_affected - total)
+        if size == 0:
+            return total, session.execute(remaining.limit(1)).first() is None
+        chunk = remaining.limit(size).scalar_subquery()
+        statement = build([Student.id.in_(chunk)]).returning(Student.id)
+        ids = session.execute(statement).scalars().all()
+        session.commit()
+        total += len(ids)
+        if len(ids) < size:
+            return total, True
+        last_id = max(ids)
+
+def with_student_location(response):
+    """
+    Point the Location header of a response that carries a student at that student.
+    """
+    body = response.get_json(silent=True)
+    if isinstance(body, dict) and "id" in body:
+        response.headers["Location"] = url_for("get_student", student_id=body["id"])
+    return response
+
+def student_etag(version):
+    """
+    Strong ETag of a student at the given row version.
+    """
+    return f"v{version}"
+
+def write_student(student_id, build):
+    """
+    Run a single-row UPDATE or DELETE ... RETURNING guarded by If-Match, and commit.
+
+    build(clauses) returns the statement restricted by the given WHERE clauses. The
+    versions named by If-Match are one of them, so the check and the write are a
+    single statement: no lock is held between the client's read and its write, and
+    a concurrent writer just makes the statement match no row.
+
+    Returns the written row and None, or None and an error response: 428 without
+    If-Match, 404 for an unknown student and 412, with the current ETag, when the
+    student has changed since. When the student matches If-Match but the statement
+    skipped it because there was nothing to change, the current row is returned.
+    """
+    if not request.if_match:
+        return None, (jsonify({"error": "If-Match is required"}), 428)
+    table = Student.__table__
+    clauses = [table.c.id == student_id]
+    if not request.if_match.star_tag:
+        versions = [int(tag[1:]) for tag in request.if_match.as_set()
+                    if tag.startswith("v") and tag[1:].isdigit()]
+        clauses.append(table.c.version.in_(versions))
+
+    session = db.session  # pylint: disable=no-member
+    try:
+        row = session.execute(build(clauses)).first()
+    except IntegrityError as exc:
+        session.rollback()
+        return None, (jsonify({"error": str(exc.orig).splitlines()[0]}), 409)
+    if row is not None:
+        session.commit()
+        return row, None
+
+    session.rollback()
+    row = session.execute(select(table).where(*clauses)).first()
+    if row is not None:
+        return row, None
+    version = session.execute(select(table.c.version).where(table.c.id == student_id)).scalar()
+    if version is None:
+        return None, (jsonify({"error": "Student not found"}), 404)
+    response = jsonify({"error": "Student has been modified"})
+    response.status_code = 412
+    response.set_etag(student_etag(version))
+    return None, response
+
+def update_student(student_id, values):
+    """
+    Set the given columns of one student, guarded by If-Match, with write_student.
+
+    Only those columns appear in the UPDATE, and a student that already holds the
+    values is not written at all, so no-op edits create no new row version.
+    """
+    table = Student.__table__
+    if not values:
+        return write_student(student_id, lambda clauses: select(table).where(*clauses))
+    unchanged = tuple_(*(table.c[name] for name in values)).is_distinct_from(
+        tuple_(*values.values()))
+    return write_student(student_id, lambda clauses: table.update().where(
+        *clauses, unchanged).values(
+            {**values, "version": table.c.version + 1}).returning(*table.c))
+
+def requested_patch(data):
+    """
+    Parse a JSON Merge Patch of a student into the column values it sets.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Patch must be an object")
+    values = {}
+    for field, value in data.items():
+        if field == "name" and isinstance(value, str) and 0 < len(value) <= 100:
+            values[field] = value
+        elif field == "age" and is_int(value):
+            values[field] = value
+        elif field == "external_id" and (
+                value is None or isinstance(value, str) and 0 < len(value) <= 64):
+            values[field] = value
+        else:
+            raise ValueError(f"Cannot set {field} to {value!r}")
+    return values
+
+def requested_fields():
+    """
+    Parse the `fields` query parameter, or return None when every field is wanted.
+    """
+    raw = request.args.get("fields")
+    if raw is None:
+        return None
+    fields = list(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    if not fields or not set(fields) <= set(STUDENT_FIELDS):
+        raise ValueError("Unknown field")
+    return fields
+
+def requested_filters():
+    """
+    Translate the filter query parameters into WHERE clauses.
+    """
+    args = request.args
+    clauses = []
+    if "age" in args:
+        clauses.append(Student.age == int(args["age"]))
+    if "age_min" in args:
+        clauses.append(Student.age >= int(args["age_min"]))
+    if "age_max" in args:
+        clauses.append(Student.age <= int(args["age_max"]))
+    if "name" in args:
+        clauses.append(Student.name == args["name"])
+    if "name_prefix" in args:
+        clauses.append(Student.name.startswith(args["name_prefix"], autoescape=True))
+    return clauses
+
+def requested_sort():
+    """
+    Parse the `sort` query parameter, a field name optionally prefixed with "-"
+    for descending order.
+
+    Returns the raw value and the columns to order by, the id breaking ties.
+    """
+    raw = request.args.get("sort", "id")
+    name = raw[1:] if raw.startswith("-") else raw
+    if name not in SORT_KEYS:
+        raise ValueError("Unknown sort key")
+    column = getattr(Student, name)
+    return raw, [column] if name == "id" else [column, Student.id]
+
+def sort_expression(key):
+    """
+    Expression that a sort key is ordered and compared by in SQL.
+
+    Across shards names are compared in the "C" collation, code point order, which
+    is the order the shards' rows are merged in.
+    """
+    if shard_router.shards and key.type.python_type is str:
+        return key.collate("C")
+    return key
+
+def keyset_after(keys, descending, values):
+    """
+    WHERE clause selecting the rows that follow the given sort key values.
+    """
+    if len(values) != len(keys) or not all(
+            isinstance(v, k.type.python_type) and not isinstance(v, bool)
+            for k, v in zip(keys, values)):
+        raise ValueError("Cursor does not match the sort order")
+    if len(keys) == 1:
+        left, right = sort_expression(keys[0]), values[0]
+    else:
+        left, right = tuple_(*map(sort_expression, keys)), tuple_(*values)
+    return left < right if descending else left > right
+
+def student_query(fields, sort_key="id"):
+    """
+    Build the base query for students.
+
+    Full rows are loaded as Student entities unless STUDENTS_READ_PATH is "core".
+    Otherwise, and whenever only some fields are requested, a Core SELECT of just
+    those columns (plus the id and sort key, which the cursor needs) is returned
+    so rows skip ORM hydration entirely.
+    """
+    if fields is None and app.config['STUDENTS_READ_PATH'] != "core":
+        return Student.query
+    names = dict.fromkeys(["id", sort_key, *(fields or STUDENT_FIELDS)])
+    return select(*(Student.__table__.c[name] for name in names))
+
+def execute_student_query(query, batch_size=None):
+    """
+    Run a query built by student_query and return its Students or rows.
+
+    With batch_size, rows are read lazily from a server-side cursor that many
+    at a time.
+    """
+    if not isinstance(query, Select):
+        return query.yield_per(batch_size) if batch_size else query.all()
+    connection = db.session.connection()  # pylint: disable=no-member
+    if batch_size:
+        query = query.execution_options(stream_results=True)
+        return connection.execute(query).yield_per(batch_size)
+    return connection.execute(query).all()
+
+def encode_cursor(values):
+    """
+    Encode the sort key of the last row on a page as an opaque cursor.
+    """
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    """
+    Decode a cursor produced by encode_cursor, raising ValueError if it is malformed.
+    """
+    values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    # bool is a subclass of int, but no sort key is a boolean
+    if not isinstance(values, list) or not all(
+            isinstance(v, (int, str)) and not isinstance(v, bool) for v in values):
+        raise ValueError("Malformed cursor")
+    return values
+
+def page_limit():
+    """
+    Read the requested page size, falling back to the default and capping it.
+    """
+    raw = request.args.get("limit")
+    if raw is None:
+        return app.config['STUDENTS_PAGE_SIZE']
+    limit = int(raw)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, app.config['STUDENTS_MAX_PAGE_SIZE'])
+
+def stream_mimetype():
+    """
+    Mimetype of the streamed listing the client asked for, or None for a single page.
+    """
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    if best == NDJSON_MIMETYPE:
+        return NDJSON_MIMETYPE
+    if request.args.get("stream") == "1":
+        return "application/json"
+    return None
+
+def stream_students(query, fields, mimetype, read=execute_student_query):
+    """
+    Stream every row of the query as NDJSON or as a chunked JSON array.
+
+    Rows are read in batches through a server-side cursor and one chunk is written
+    per batch, so memory use does not depend on the size of the table. read runs
+    the query, given the batch size.
+    """
+    batch_size = app.config['STUDENTS_STREAM_BATCH_SIZE']
+    ndjson = mimetype == NDJSON_MIMETYPE
+
+    def generate():
+        chunk = []
+        first = True
+        if not ndjson:
+            yield "["
+        for s in read(query, batch_size):
+            row = json_dumps(student_to_dict(s, fields), separators=(",", ":"))
+            if ndjson:
+                chunk.append(row + "\n")
+            else:
+                chunk.append(row if first else "," + row)
+                first = False
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+        if not ndjson:
+            yield "]"
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+class NDJSONAsCSV:
+    """
+    Read-only file that turns an NDJSON byte stream into CSV rows for COPY.
+
+    Lines are converted as COPY asks for data, so only about one read buffer of
+    the upload is held in memory at a time.
+    """
+    def __init__(self, stream, columns):
+        self.lines = iter(stream)
+        self.columns = columns
+        self.buffer = bytearray()
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text, lineterminator="\n")
+        self.error = None
+
+    def read(self, size=-1):
+        """
+        Return up to size bytes of CSV, or everything left when size is negative.
+        """
+        try:
+            self.fill(size)
+        except ValueError as exc:
+            # COPY reports this as a cancelled query; keep it for the caller
+            self.error = exc
+            raise
+        if size < 0:
+            size = len(self.buffer)
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return chunk
+
+    def fill(self, size):
+        """
+        Convert lines until the buffer holds size bytes or the stream ends.
+        """
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                raise ValueError("Each line must be a JSON object")
+            self.writer.writerow([item.get(column) for column in self.columns])
+            self.buffer += self.text.getvalue().encode()
+            self.text.seek(0)
+            self.text.truncate()
+
+IMPORT_COLUMNS = ("id", "name", "age")
+
+def import_students(stream, fmt):
+    """
+    Load a CSV or NDJSON stream into the student table, without committing.
+
+    The stream is copied with COPY FROM STDIN into a temporary staging table and
+    merged into student with one INSERT ... SELECT. Rows with an id replace the
+    student with that id, the last one winning when an id repeats; rows without
+    one are created. CSV input must start with a header naming its columns.
+
+    Returns the number of inserted and updated students.
+    """
+    if fmt == "csv":
+        columns = next(csv.reader([stream.readline().decode("utf-8-sig")]), [])
+        columns = [column.strip() for column in columns]
+        if not {"name", "age"} <= set(columns) or not set(columns) <= set(IMPORT_COLUMNS):
+            raise ValueError("CSV header must name the name and age columns, and optionally id")
+        source = stream
+    else:
+        columns = list(IMPORT_COLUMNS)
+        source = NDJSONAsCSV(stream, columns)
+
+    table = Student.__tablename__
+    cursor = db.session.connection().connection.cursor()  # pylint: disable=no-member
+    cursor.execute("CREATE TEMPORARY TABLE student_import "
+                   "(line bigserial, id integer, name varchar(100), age integer)")
+    try:
+        cursor.copy_expert(
+            f"COPY student_import ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", source)
+    except psycopg2.errors.QueryCanceled:
+        if getattr(source, "error", None) is not None:
+            raise source.error from None
+        raise
+    # ON CONFLICT cannot update a row twice, so only the last line of an id is merged
+    rows = "student_import"
+    if "id" in columns:
+        rows = """(
+            SELECT *, row_number() OVER (PARTITION BY id ORDER BY line DESC) AS newer
+            FROM student_import
+        ) AS latest WHERE id IS NULL OR newer = 1"""
+    cursor.execute(f"""
+        WITH merged AS (
+            INSERT INTO {table} (id, name, age)
+            SELECT COALESCE(id, nextval(pg_get_serial_sequence('{table}', 'id'))), name, age
+            FROM {rows}
+            ON CONFLICT (id) DO UPDATE
+            SET name = EXCLUDED.name, age = EXCLUDED.age, version = {table}.version + 1
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+        FROM merged
+    """)
+    inserted, updated = cursor.fetchone()
+    if "id" in columns:
+        # Explicit ids may run past the sequence; move it forward, never back
+        cursor.execute(f"""
+            SELECT setval(seq, GREATEST((SELECT max(id) FROM {table}), nextval(seq)))
+            FROM pg_get_serial_sequence('{table}', 'id') AS seq
+        """)
+    cursor.execute("DROP TABLE student_import")
+    return inserted, updated
+
+replica_router = ReplicaRouter(
+    [name for name in app.config['SQLALCHEMY_BINDS'] if name.startswith("replica")],
+    lambda name: db.get_engine(app, bind=name),
+    app.config['READ_ROUTING'])
+
+@app.before_request
+def route_reads():
+    """
+    Send the queries of GET requests to a replica that has caught up with the client.
+    """
+    if request.method in ("GET", "HEAD") and replica_router.replicas:
+        g.read_engine = replica_router.choose(request.headers.get("X-Consistency-Token"))
+
+@app.after_request
+def send_consistency_token(response):
+    """
+    Hand the primary's WAL position to clients after a write, so that their next
+    reads can wait for it.
+    """
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400 \
+            and replica_router.replicas:
+        lsn = db.session.execute(  # pylint: disable=no-member
+            text("SELECT pg_current_wal_insert_lsn()")).scalar()
+        response.headers["X-Consistency-Token"] = lsn
+    return response
+
+shard_router = ShardRouter(
+    [name for name in app.config['SQLALCHEMY_BINDS'] if name.startswith("shard")],
+    lambda name: db.get_engine(app, bind=name),
+    Student.__table__, ShardRange.__table__,
+    range_size=app.config['SHARD_RANGE_SIZE'],
+    map_ttl=app.config['SHARD_MAP_TTL'],
+    workers=app.config['SHARD_FANOUT_WORKERS'])
+
+def use_shard(shard):
+    """
+    Run the rest of the request's queries on a shard, in a new transaction.
+    """
+    db.session.rollback()  # pylint: disable=no-member
+    g.shard_engine = db.get_engine(app, bind=shard)
+
+def shard_by_id(view):
+    """
+    Run a single-student view on the shard that owns the student id.
+
+    A 404 may come from a shard map that is out of date because the id was just
+    moved, so the map is then reloaded and the view run again on the new owner.
+    """
+    @functools.wraps(view)
+    def wrapper(student_id, **kwargs):
+        if not shard_router.shards:
+            return view(student_id, **kwargs)
+        owner = None
+        for refresh in (False, True):
+            shard = shard_router.shard_for(student_id, refresh)
+            if shard is None or shard == owner:
+                break
+            use_shard(shard)
+            response = make_response(view(student_id, **kwargs))
+            if response.status_code != 404:
+                return response
+            owner = shard
+        return jsonify({"error": "Student not found"}), 404
+    return wrapper
+
+def unsharded(view):
+    """
+    Refuse a route that cannot yet run across shards with 501 when sharding is on.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if shard_router.shards:
+            return jsonify({"error": "Not supported on a sharded database"}), 501
+        return view(*args, **kwargs)
+    return wrapper
+
+def insert_sharded_student(row):
+    """
+    Insert and commit a student on the next shard in turn, and return it.
+
+    The shard's sequence hands out ids from the range it leased last; once that
+    is used up the shard leases the next free range and the insert is repeated.
+    """
+    shard = shard_router.next_shard()
+    use_shard(shard)
+    try:
+        student = insert_students([row])[0]
+    except DBAPIError as exc:
+        if not isinstance(exc.orig, psycopg2.errors.SequenceGeneratorLimitExceeded):
+            raise
+        db.session.rollback()  # pylint: disable=no-member
+        shard_router.lease(shard)
+        student = insert_students([row])[0]
+    db.session.commit()  # pylint: disable=no-member
+    return student
+
+def shard_statement(query):
+    """
+    The Core SELECT of a student query, to run on the shards' own connections.
+    """
+    return query if isinstance(query, Select) else query.statement
+
+def fan_out_students(query, keys, descending, limit):
+    """
+    Run a listing query on every shard in parallel and return the first limit rows
+    of their results merged in keyset order.
+    """
+    statement = shard_statement(query).limit(limit)
+    deadline = g.get("deadline")
+
+    def run(engine, id_ranges):
+        with engine.connect() as connection, connection.begin():
+            if deadline is not None:
+                limit_statement_time(connection, deadline)
+            return connection.execute(statement.where(in_ranges(Student.id, id_ranges))).all()
+
+    merged = heapq.merge(*shard_router.fan_out(run),
+                         key=operator.attrgetter(*(key.key for key in keys)), reverse=descending)
+    return list(itertools.islice(merged, limit))
+
+def stream_shards(query, batch_size, keys, descending):
+    """
+    Lazily merge the rows of a listing query, read from a server-side cursor on
+    every shard, in keyset order.
+    """
+    statement = shard_statement(query).execution_options(stream_results=True)
+    deadline = g.get("deadline")
+
+    def rows(engine, id_ranges):
+        with engine.connect() as connection, connection.begin():
+            if deadline is not None:
+                limit_statement_time(connection, deadline)
+            yield from connection.execute(
+                statement.where(in_ranges(Student.id, id_ranges))).yield_per(batch_size)
+
+    return heapq.merge(*itertools.starmap(rows, shard_router.placements()),
+                       key=operator.attrgetter(*(key.key for key in keys)), reverse=descending)
 
 @app.route("/", methods=["GET"])
 def health_check():
@@ -51,30 +1463,455 @@ def health_check():
     hostname = socket.gethostname()
     return jsonify({"message": f"Hello from {hostname}!"})
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Internal metrics of this worker.
+    """
+    pool = db.engine.pool
+    return jsonify({
+        "pool": pool.metrics() if isinstance(pool, InstrumentedQueuePool) else None,
+        "read_routing": replica_router.metrics() if replica_router.replicas else None,
+        "retries": retry_policy.metrics(),
+        "group_commit": group_committer.metrics(),
+        "write_behind": write_behind_log.metrics(),
+        "sharding": shard_router.metrics() if shard_router.shards else None,
+    })
+
 @app.route("/students", methods=["POST"])
+@time_budget('WRITE_BUDGET_MS')
+@retry_transient(idempotent=lambda: "Idempotency-Key" in request.headers)
 def create_student():
     """
-    Create a new student.
+    Create a new student and return it as persisted, generated id included, from
+    a single INSERT ... RETURNING.
+
+    With an `Idempotency-Key` header the response is stored in the same transaction
+    as the insert, and a retry with the same key replays it without writing again.
     """
+    key = request.headers.get("Idempotency-Key")
+    key_hash = hashlib.sha256(key.encode()).digest() if key else None
+    if key_hash and shard_router.shards:
+        return jsonify({"error": "Idempotency-Key is not supported on a sharded database"}), 501
+    if key_hash:
+        replay = stored_response(key_hash)
+        if replay is not None:
+            return with_student_location(replay)
+
     data = request.get_json()
-    name = data.get("name")
-    age = data.get("age")
+    error = student_error(data)
+    if error:
+        return jsonify({"error": error}), 400
 
-    if not name or age is None:
-        return jsonify({"error": "Name and age are required"}), 400
+    row = {"name": data["name"], "age": data["age"]}
+    # While another process owns the log the create is written synchronously
+    if app.config['STUDENTS_WRITE_BEHIND'] and not key_hash and not shard_router.shards \
+            and write_behind_log.start():
+        tracking_id = write_behind_log.append(row)
+        response = jsonify({"status": "pending", "tracking_id": tracking_id})
+        response.headers["Location"] = url_for("get_write_status", tracking_id=tracking_id)
+        return response, 202
+
+    if shard_router.shards:
+        student = insert_sharded_student(row)
+    elif app.config['STUDENTS_GROUP_COMMIT'] and not key_hash:
+        # The batch commits in another thread, so count it as this request's commit
+        g.commits["started"] += 1
+        student = group_committer.submit(row)
+    else:
+        student = insert_students([row])[0]
+        if key_hash and not store_response(key_hash, 201, student):
+            # A concurrent retry won the race; drop our insert and replay its response
+            db.session.rollback()  # pylint: disable=no-member
+            return with_student_location(stored_response(key_hash))
+        db.session.commit()      # pylint: disable=no-member
+
+    return with_student_location(make_response(jsonify(student), 201))
+
+@app.route("/students/writes/<tracking_id>", methods=["GET"])
+@time_budget('READ_BUDGET_MS')
+@retry_transient(idempotent=True)
+def get_write_status(tracking_id):
+    """
+    Status of a create accepted in write-behind mode: pending, applied or failed.
+
+    A recent tracking id unknown to this worker is reported as pending, since the
+    worker whose log holds it may not have applied it yet.
+    """
+    if write_behind_log.is_pending(tracking_id):
+        return jsonify({"status": "pending", "tracking_id": tracking_id})
+
+    stored = IdempotencyKey.query.get(write_behind_key(tracking_id))
+    if stored is None:
+        # Another worker may still hold it in its log; outcomes are kept as long
+        issued_at = WriteBehindLog.issued_at(tracking_id)
+        if issued_at is not None and time.time() - issued_at < app.config['IDEMPOTENCY_KEY_TTL']:
+            return jsonify({"status": "pending", "tracking_id": tracking_id})
+        return jsonify({"error": "Unknown tracking id"}), 404
+    return jsonify(dict(json.loads(stored.body), tracking_id=tracking_id))
+
+@app.route("/students/bulk", methods=["POST"])
+@time_budget('BULK_BUDGET_MS')
+@retry_transient()
+@unsharded
+def create_students_bulk():
+    """
+    Create a list of students in one transaction.
+
+    Invalid items are reported by index and skipped, unless `?atomic=1` is given,
+    in which case any invalid item rejects the whole batch. The created ids are
+    returned in request order, with null for skipped items.
+    """
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({"error": "Expected a list of students"}), 400
+    max_items = app.config['STUDENTS_BULK_MAX_ITEMS']
+    if len(data) > max_items:
+        return jsonify({"error": f"At most {max_items} students per request"}), 413
+
+    rows, positions, errors = [], [], []
+    for index, item in enumerate(data):
+        error = student_error(item)
+        if error:
+            errors.append({"index": index, "error": error})
+        else:
+            rows.append({"name": item["name"], "age": item["age"]})
+            positions.append(index)
+
+    if errors and (request.args.get("atomic") == "1" or not rows):
+        return jsonify({"error": "Invalid students", "errors": errors}), 400
+
+    ids = [None] * len(data)
+    for position, student in zip(positions, insert_students(rows)):
+        ids[position] = student["id"]
+    db.session.commit()  # pylint: disable=no-member
+
+    return jsonify({"ids": ids, "errors": errors}), 201
+
+@app.route("/students:upsert", methods=["PUT"])
+@time_budget('BULK_BUDGET_MS')
+@retry_transient(idempotent=True)
+@unsharded
+def upsert_students_by_external_id():
+    """
+    Create or update students by their `external_id`.
+
+    Accepts one student or a list of them, and reports how many were inserted,
+    updated, and left unchanged because nothing differed.
+    """
+    data = request.get_json()
+    items = data if isinstance(data, list) else [data]
+    max_items = app.config['STUDENTS_BULK_MAX_ITEMS']
+    if len(items) > max_items:
+        return jsonify({"error": f"At most {max_items} students per request"}), 413
+
+    errors, seen = [], set()
+    for index, item in enumerate(items):
+        error = student_error(item)
+        external_id = item.get("external_id") if isinstance(item, dict) else None
+        if not error and (not isinstance(external_id, str) or not 0 < len(external_id) <= 64):
+            error = "external_id must be a string of 1 to 64 characters"
+        if not error and external_id in seen:
+            error = "Duplicate external_id in request"
+        if error:
+            errors.append({"index": index, "error": error})
+        seen.add(external_id)
+    if errors:
+        return jsonify({"error": "Invalid students", "errors": errors}), 400
+
+    rows = [{"external_id": i["external_id"], "name": i["name"], "age": i["age"]}
+            for i in items]
+    inserted, updated, unchanged = upsert_students(rows)
+    # A batch with nothing to change writes nothing
+    if inserted or updated:
+        db.session.commit()  # pylint: disable=no-member
+    else:
+        db.session.rollback()  # pylint: disable=no-member
+
+    return jsonify({"inserted": inserted, "updated": updated, "unchanged": unchanged})
+
+@app.route("/students", methods=["PATCH"])
+@time_budget('BULK_BUDGET_MS')
+@retry_transient()
+@unsharded
+def update_students():
+    """
+    Update every student matched by the filter query parameters.
+    """
+    try:
+        changes = requested_changes(request.get_json())
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    table = Student.__table__
+    changes["version"] = table.c.version + 1
+    try:
+        return filtered_write(lambda clauses: table.update().where(*clauses).values(changes),
+                              "updated")
+    except DataError:
+        # An increment took an age out of range; batches already committed stay
+        db.session.rollback()  # pylint: disable=no-member
+        return jsonify({"error": "The increment takes an age out of range"}), 400
+
+@app.route("/students", methods=["DELETE"])
+@time_budget('BULK_BUDGET_MS')
+@retry_transient()
+@unsharded
+def delete_students():
+    """
+    Delete every student matched by the filter query parameters.
+    """
+    table = Student.__table__
+    return filtered_write(lambda clauses: table.delete().where(*clauses), "deleted")
+
+@app.route("/students/import", methods=["POST"])
+@time_budget('IMPORT_BUDGET_MS')
+@unsharded
+def import_students_upload():
+    """
+    Import students from a CSV (`text/csv`) or NDJSON (`application/x-ndjson`) body.
 
-    student = Student(name=name, age=age)
+    The body is streamed into Postgres with COPY and never held in memory.
+    """
+    formats = {CSV_MIMETYPE: "csv", NDJSON_MIMETYPE: "ndjson"}
+    if request.mimetype not in formats:
+        return jsonify({"error": "Content-Type must be text/csv or application/x-ndjson"}), 415
 
-    db.session.add(student)  # pylint: disable=no-member
-    db.session.commit()      # pylint: disable=no-member
+    try:
+        inserted, updated = import_students(request.stream, formats[request.mimetype])
+    except (ValueError, psycopg2.DataError, psycopg2.IntegrityError) as exc:
+        db.session.rollback()  # pylint: disable=no-member
+        return jsonify({"error": str(exc).splitlines()[0]}), 400
+    db.session.commit()  # pylint: disable=no-member
 
-    return jsonify({"message": "Student created successfully"}), 201
+    return jsonify({"inserted": inserted, "updated": updated})
 
 @app.route("/students", methods=["GET"])
+@time_budget('READ_BUDGET_MS')
+@retry_transient(idempotent=True)
+@conditional(Student.__table__)
 def get_students():
     """
-    Retrieve all students.
+    Retrieve one page of students, ordered by id unless `sort` says otherwise.
+
+    Pages are walked with an opaque `after` cursor instead of an offset, so every
+    page is a single index range scan on the primary key. The URL of the following
+    page, if any, is returned in the `Link` header.
+
+    With `Accept: application/x-ndjson` or `?stream=1` the remaining rows are
+    streamed in one response instead (NDJSON, or a chunked JSON array).
+
+    `?fields=id,name` limits the response, and the SELECT, to the given columns.
+    `age`, `age_min`, `age_max`, `name` and `name_prefix` filter the rows.
+    """
+    try:
+        limit = page_limit()
+        fields = requested_fields()
+        filters = requested_filters()
+        sort, keys = requested_sort()
+        descending = sort.startswith("-")
+        # Unfiltered pages of full rows in id order are the hot path served by prepared
+        # statements, which select every column
+        prepared = None
+        if sort == "id" and not filters and fields is None and use_prepared_statements():
+            prepared = ["student_page_first"]
+        if "after" in request.args:
+            cursor = decode_cursor(request.args["after"])
+            if not cursor or cursor[0] != sort:
+                raise ValueError("Cursor does not match the sort order")
+            filters.append(keyset_after(keys, descending, cursor[1:]))
+            # The prepared $1 is an integer, so larger ids take the unprepared query
+            prepared = prepared and is_int(cursor[1]) and ["student_page_after", cursor[1]]
+    except ValueError:
+        return jsonify({"error": "Invalid limit, cursor, fields, filter or sort"}), 400
+
+    query = student_query(fields, keys[0].key).filter(*filters).order_by(
+        *(sort_expression(key).desc() if descending else sort_expression(key) for key in keys))
+
+    mimetype = stream_mimetype()
+    if mimetype and shard_router.shards:
+        return stream_students(query, fields or STUDENT_FIELDS, mimetype, functools.partial(
+            stream_shards, keys=keys, descending=descending))
+    if mimetype:
+        return stream_students(query, fields or STUDENT_FIELDS, mimetype)
+
+    # Fetch one extra row to learn whether another page follows
+    if shard_router.shards:
+        students = fan_out_students(query, keys, descending, limit + 1)
+    elif prepared:
+        students = execute_prepared(*prepared, limit + 1)
+    else:
+        students = execute_student_query(query.limit(limit + 1))
+    has_more = len(students) > limit
+    students = students[:limit]
+
+    result = [student_to_dict(s, fields or STUDENT_FIELDS) for s in students]
+    response = jsonify(result)
+    if has_more:
+        args = request.args.to_dict()
+        args["after"] = encode_cursor([sort] + [getattr(students[-1], k.key) for k in keys])
+        response.headers["Link"] = f'<{url_for("get_students", **args)}>; rel="next"'
+    return response
+
+@app.route("/students/<int:student_id>", methods=["GET"])
+@time_budget('READ_BUDGET_MS')
+@retry_transient(idempotent=True)
+@shard_by_id
+def get_student(student_id):
+    """
+    Retrieve a single student by id.
+
+    The row version is returned as a strong ETag, to send back in If-Match when
+    updating or deleting the student, and answers If-None-Match with 304.
+    """
+    try:
+        fields = requested_fields()
+    except ValueError:
+        return jsonify({"error": "Invalid fields"}), 400
+
+    if fields is None and use_prepared_statements() and is_int(student_id):
+        students = execute_prepared("student_by_id", student_id)
+    else:
+        query = student_query(fields and [*fields, "version"]).filter(
+            Student.id == student_id).limit(1)
+        students = execute_student_query(query)
+    if not students:
+        return jsonify({"error": "Student not found"}), 404
+
+    response = jsonify(student_to_dict(students[0], fields or STUDENT_FIELDS))
+    response.set_etag(student_etag(students[0].version))
+    return response.make_conditional(request)
+
+@app.route("/students/<int:student_id>", methods=["PUT"])
+@time_budget('WRITE_BUDGET_MS')
+@retry_transient()
+@shard_by_id
+def replace_student(student_id):
+    """
+    Replace a student's name, age and external_id, if it still matches If-Match.
+    """
+    data = request.get_json()
+    error = student_error(data)
+    external_id = data.get("external_id") if isinstance(data, dict) else None
+    if not error and external_id is not None and (
+            not isinstance(external_id, str) or not 0 < len(external_id) <= 64):
+        error = "external_id must be a string of 1 to 64 characters"
+    if error:
+        return jsonify({"error": error}), 400
+
+    values = {"name": data["name"], "age": data["age"], "external_id": external_id}
+    row, error = update_student(student_id, values)
+    if error:
+        return error
+
+    response = jsonify(student_to_dict(row))
+    response.set_etag(student_etag(row.version))
+    return response
+
+@app.route("/students/<int:student_id>", methods=["PATCH"])
+@time_budget('WRITE_BUDGET_MS')
+@retry_transient()
+@shard_by_id
+def patch_student(student_id):
+    """
+    Apply a JSON Merge Patch to a student, if it still matches If-Match.
+
+    Only the columns named in the patch are updated, and nothing is written when
+    they already hold the patched values.
+    """
+    try:
+        values = requested_patch(request.get_json())
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    row, error = update_student(student_id, values)
+    if error:
+        return error
+
+    response = jsonify(student_to_dict(row))
+    response.set_etag(student_etag(row.version))
+    return response
+
+@app.route("/students/<int:student_id>", methods=["DELETE"])
+@time_budget('WRITE_BUDGET_MS')
+@retry_transient()
+@shard_by_id
+def delete_student(student_id):
+    """
+    Delete a student, if it still matches If-Match.
+    """
+    table = Student.__table__
+    _, error = write_student(student_id, lambda clauses: table.delete().where(
+        *clauses).returning(table.c.id))
+    return error or Response(status=204)
+
+students_cli = AppGroup("students", help="Manage student records.")
+app.cli.add_command(students_cli)
+
+@students_cli.command("import")
+@click.argument("file", type=click.File("rb"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]),
+              help="Input format, guessed from the file extension by default.")
+def import_students_command(file, fmt):
+    """
+    Import students from a CSV or NDJSON file ("-" for stdin) with COPY.
+    """
+    if shard_router.shards:
+        raise click.UsageError("Imports are not supported on a sharded database.")
+    if fmt is None:
+        fmt = "ndjson" if file.name.endswith((".ndjson", ".jsonl")) else "csv"
+    inserted, updated = import_students(file, fmt)
+    db.session.commit()  # pylint: disable=no-member
+    click.echo(f"Inserted {inserted} and updated {updated} students.")
+
+@students_cli.command("sweep-idempotency-keys")
+def sweep_idempotency_keys_command():
+    """
+    Delete expired idempotency keys.
+    """
+    click.echo(f"Deleted {sweep_idempotency_keys()} expired idempotency keys.")
+
+shards_cli = AppGroup("shards", help="Manage the shards of the student table.")
+app.cli.add_command(shards_cli)
+
+@shards_cli.command("init")
+def init_shards_command():
+    """
+    Create the student table on every shard and lease each shard its first ids.
+    """
+    if not shard_router.shards:
+        raise click.UsageError("Set SHARD_DATABASE_URLS to the shard databases first.")
+    owners = {shard for _, _, shard in shard_router.current_map(refresh=True)}
+    for shard in shard_router.shards:
+        engine = db.get_engine(app, bind=shard)
+        db.Model.metadata.create_all(engine, tables=[TableVersion.__table__, Student.__table__])
+        with engine.begin() as connection:
+            connection.execute(SHARD_NAME_INDEX)
+        if shard not in owners:
+            low, high = shard_router.lease(shard)
+            click.echo(f"Leased ids {low} to {high - 1} to {shard}.")
+
+@shards_cli.command("ranges")
+def list_shard_ranges_command():
+    """
+    Show which shard owns each range of ids.
+    """
+    for low, high, shard in shard_router.current_map(refresh=True):
+        click.echo(f"{low:>12} {high - 1:>12}  {shard}")
+
+@shards_cli.command("move")
+@click.argument("low", type=int)
+@click.argument("high", type=int)
+@click.argument("target")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Rows copied per transaction before the switch.")
+def move_shard_range_command(low, high, target, batch_size):
+    """
+    Move the students with ids from LOW to HIGH, inclusive, to the TARGET shard
+    while the API keeps serving them.
     """
-    students = Student.query.all()
-    result = [{"id": s.id, "name": s.name, "age": s.age} for s in students]
-    return jsonify(result)
+    try:
+        moved = shard_router.move(low, high + 1, target, batch_size, click.echo)
+    except ValueError as exc:
+        raise click.UsageError(str(exc)) from exc
+    click.echo(f"Moved {moved} students to {target}.")
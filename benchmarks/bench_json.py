@@ -0,0 +1,65 @@
+"""
+Benchmark response serialization with the stdlib and orjson encoders.
+
+Serializes student listings of several sizes the way jsonify does and reports
+the time per payload for each encoder.
+
+    python benchmarks/bench_json.py --rows 10 1000 100000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+# pylint: disable=wrong-import-position
+from flask.json import JSONEncoder, dumps as json_dumps
+from app import FastJSONEncoder, app, orjson
+
+
+def payload(rows):
+    """
+    Build a student listing with the given number of rows, shaped like GET /students.
+    """
+    return [{"id": i, "name": f"Student {i}", "age": 18 + i % 10,
+             "external_id": f"ext-{i}" if i % 2 else None, "version": 1 + i % 3}
+            for i in range(rows)]
+
+
+def measure(encoder, data, number):
+    """
+    Return the mean seconds per serialization of data with the given encoder.
+    """
+    app.json_encoder = encoder
+    return timeit.timeit(lambda: json_dumps(data, separators=(",", ":")),
+                         number=number) / number
+
+
+def main():
+    """
+    Run the benchmark for every requested payload size.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 1000, 100000])
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed, both columns use the stdlib encoder")
+
+    print(f"{'rows':>8} {'bytes':>12} {'stdlib ms':>10} {'fast ms':>10} {'speedup':>8}")
+    with app.app_context():
+        for rows in args.rows:
+            data = payload(rows)
+            number = max(1, 100000 // rows)
+            size = len(json_dumps(data, separators=(",", ":")))
+            stdlib = measure(JSONEncoder, data, number)
+            fast = measure(FastJSONEncoder, data, number)
+            print(f"{rows:>8} {size:>12,} {stdlib * 1000:>10.3f} {fast * 1000:>10.3f} "
+                  f"{stdlib / fast:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
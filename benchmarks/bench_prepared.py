@@ -0,0 +1,106 @@
+"""
+Benchmark the hot student queries with and without prepared statements.
+
+Fills the students table with N rows and reports the median and 99th percentile
+latency of get by id, first page and single insert, run as plain statements and
+as server-side prepared statements. Needs Postgres at BENCH_DATABASE_URL.
+
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/bench_prepared.py --rows 100000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+if not os.getenv("BENCH_DATABASE_URL", "").startswith("postgresql"):
+    sys.exit("Set BENCH_DATABASE_URL to a Postgres database")
+os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+
+# pylint: disable=wrong-import-position
+from app import (Student, app, db, execute_prepared, execute_student_query,
+                 insert_students, student_query)
+
+INSERT_BATCH = 10000
+
+
+def fill(rows):
+    """
+    Recreate the students table with the given number of rows.
+    """
+    db.drop_all(bind=None)
+    db.create_all(bind=None)
+    table = Student.__table__
+    for start in range(0, rows, INSERT_BATCH):
+        batch = [{"name": f"Student {i}", "age": 18 + i % 10}
+                 for i in range(start, min(start + INSERT_BATCH, rows))]
+        db.session.execute(table.insert(), batch)  # pylint: disable=no-member
+    db.session.commit()  # pylint: disable=no-member
+
+
+def queries(rows, prepared):
+    """
+    The benchmarked queries as name, function pairs, run either way.
+
+    The insert follows PREPARED_STATEMENTS, which measure() is called under.
+    """
+    def get_by_id():
+        student_id = random.randint(1, rows)
+        if prepared:
+            return execute_prepared("student_by_id", student_id)
+        return execute_student_query(student_query(None).where(Student.id == student_id))
+
+    def first_page():
+        if prepared:
+            return execute_prepared("student_page_first", 101)
+        return execute_student_query(student_query(None).order_by(Student.id).limit(101))
+
+    def insert():
+        return insert_students([{"name": "Bench Student", "age": 20}])
+
+    return [("get by id", get_by_id), ("first page", first_page), ("insert", insert)]
+
+
+def measure(query, count):
+    """
+    Return the median and 99th percentile latency of query in microseconds.
+    """
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        query()
+        latencies.append((time.perf_counter() - started) * 1e6)
+    db.session.rollback()  # pylint: disable=no-member
+    return statistics.median(latencies), statistics.quantiles(latencies, n=100)[98]
+
+
+def main():
+    """
+    Run the benchmark for every query, plain and prepared.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'query':<12} {'plain p50':>10} {'p99':>8} {'prepared p50':>13} {'p99':>8} "
+          f"{'speedup':>8}")
+    app.config['STUDENTS_READ_PATH'] = "core"
+    with app.app_context():
+        fill(args.rows)
+        plain = queries(args.rows, prepared=False)
+        prepared = queries(args.rows, prepared=True)
+        for (name, run_plain), (_, run_prepared) in zip(plain, prepared):
+            app.config['PREPARED_STATEMENTS'] = False
+            plain_p50, plain_p99 = measure(run_plain, args.queries)
+            app.config['PREPARED_STATEMENTS'] = True
+            prepared_p50, prepared_p99 = measure(run_prepared, args.queries)
+            print(f"{name:<12} {plain_p50:>8.0f}us {plain_p99:>6.0f}us {prepared_p50:>11.0f}us "
+                  f"{prepared_p99:>6.0f}us {plain_p50 / prepared_p50:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
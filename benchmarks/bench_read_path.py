@@ -0,0 +1,76 @@
+"""
+Benchmark the ORM and Core read paths of the student listing.
+
+Fills the students table with N rows and reports how many rows per second each
+STUDENTS_READ_PATH turns into response dicts. Runs against BENCH_DATABASE_URL,
+or a throwaway SQLite file when it is not set.
+
+    python benchmarks/bench_read_path.py --rows 10000 100000 1000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ["DATABASE_URL"] = os.getenv(
+    "BENCH_DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "student_bench.db"))
+
+# pylint: disable=wrong-import-position
+from app import (STUDENT_FIELDS, Student, app, db, execute_student_query,
+                 student_query, student_to_dict)
+
+INSERT_BATCH = 10000
+
+
+def fill(rows):
+    """
+    Recreate the students table with the given number of rows.
+    """
+    db.drop_all()
+    db.create_all()
+    table = Student.__table__
+    for start in range(0, rows, INSERT_BATCH):
+        batch = [{"name": f"Student {i}", "age": 18 + i % 10}
+                 for i in range(start, min(start + INSERT_BATCH, rows))]
+        db.session.execute(table.insert(), batch)  # pylint: disable=no-member
+    db.session.commit()  # pylint: disable=no-member
+
+
+def measure(read_path):
+    """
+    Return rows per second for one full listing through the given read path.
+    """
+    app.config['STUDENTS_READ_PATH'] = read_path
+    db.session.expunge_all()  # pylint: disable=no-member
+    started = time.perf_counter()
+    query = student_query(None).order_by(Student.id)
+    count = len([student_to_dict(s, STUDENT_FIELDS) for s in execute_student_query(query)])
+    elapsed = time.perf_counter() - started
+    db.session.rollback()  # pylint: disable=no-member
+    return count / elapsed
+
+
+def main():
+    """
+    Run the benchmark for every requested table size.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'orm rows/s':>14} {'core rows/s':>14} {'speedup':>8}")
+    with app.app_context():
+        for rows in args.rows:
+            fill(rows)
+            orm = max(measure("orm") for _ in range(args.repeat))
+            core = max(measure("core") for _ in range(args.repeat))
+            print(f"{rows:>10} {orm:>14,.0f} {core:>14,.0f} {core / orm:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
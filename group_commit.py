@@ -0,0 +1,119 @@
+"""
+This module batches concurrent writes from one worker into shared transactions.
+
+Callers submit items from request threads and block until a background thread
+has flushed the batch their item landed in. A batch is flushed when it reaches
+max_batch items or max_delay seconds after its first item arrived, whichever
+comes first.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class GroupCommitter:
+    """
+    Collects submitted items and hands them to flush in batches.
+
+    flush receives a list of items and returns one result per item, in order.
+    A result that is an exception is raised in the thread that submitted the
+    item; if flush itself raises, every item in the batch fails with that error.
+    """
+    def __init__(self, flush, max_batch, max_delay):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stats = {
+            "batches": 0,
+            "items": 0,
+            "largest_batch": 0,
+            "histogram": dict.fromkeys(BATCH_SIZE_BUCKETS + ("+Inf",), 0),
+        }
+
+    def submit(self, item):
+        """
+        Queue an item and wait for the result of the batch it is written in.
+        """
+        self.ensure_started()
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def ensure_started(self):
+        """
+        Start the flushing thread, again after a fork since threads do not survive it.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue()
+                threading.Thread(target=self.run, name="group-commit", daemon=True).start()
+
+    def run(self):
+        """
+        Collect and flush batches forever.
+        """
+        pending = self.queue
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        """
+        Flush one batch and hand each caller its own result or error.
+        """
+        try:
+            results = self.flush([item for item, _ in batch])
+        except Exception as exc:  # pylint: disable=broad-except
+            results = [exc] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self.record(len(batch))
+
+    def record(self, size):
+        """
+        Add a flushed batch to the metrics.
+        """
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["items"] += size
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], size)
+            bucket = next((b for b in BATCH_SIZE_BUCKETS if size <= b), "+Inf")
+            self.stats["histogram"][bucket] += 1
+
+    def metrics(self):
+        """
+        Return batch size metrics as a dict.
+        """
+        with self.lock:
+            batches, items = self.stats["batches"], self.stats["items"]
+            return {
+                "batches": batches,
+                "items": items,
+                "largest_batch": self.stats["largest_batch"],
+                "mean_batch": items / batches if batches else 0,
+                "batch_size_histogram": {str(b): n for b, n in self.stats["histogram"].items()},
+                "max_batch": self.max_batch,
+                "max_delay_ms": self.max_delay * 1000,
+            }
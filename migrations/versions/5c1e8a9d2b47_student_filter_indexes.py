@@ -0,0 +1,38 @@
+"""add indexes for filtered and sorted student listings
+
+Revision ID: 5c1e8a9d2b47
+Revises: abfdfffee485
+Create Date: 2026-10-18 10:02:37.904113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8a9d2b47'
+down_revision = 'abfdfffee485'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the indexes without blocking writes to a large table
+    with op.get_context().autocommit_block():
+        op.create_index('ix_student_age_id', 'student', ['age', 'id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_student_name_id', 'student', ['name', 'id'],
+                        postgresql_concurrently=True)
+        op.create_index('ix_student_name_pattern', 'student', ['name'],
+                        postgresql_ops={'name': 'varchar_pattern_ops'},
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_student_name_pattern', table_name='student',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_student_name_id', table_name='student',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_student_age_id', table_name='student',
+                      postgresql_concurrently=True)
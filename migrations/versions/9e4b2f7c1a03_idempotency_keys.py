@@ -0,0 +1,34 @@
+"""add idempotency key store
+
+Revision ID: 9e4b2f7c1a03
+Revises: 5c1e8a9d2b47
+Create Date: 2026-10-18 11:20:45.118920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4b2f7c1a03'
+down_revision = '5c1e8a9d2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_keys',
+        sa.Column('key_hash', sa.LargeBinary(length=32), nullable=False),
+        sa.Column('status', sa.SmallInteger(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('key_hash')
+    )
+    op.create_index(op.f('ix_idempotency_keys_expires_at'), 'idempotency_keys',
+                    ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_expires_at'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,75 @@
+"""bump table versions only for statements that changed rows
+
+Revision ID: a85c3e6f0d12
+Revises: b6d2e8f41a93
+Create Date: 2026-10-18 18:20:41.902317
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a85c3e6f0d12'
+down_revision = 'b6d2e8f41a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'TRUNCATE' THEN
+                IF NOT EXISTS (SELECT FROM changed_rows) THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+            INSERT INTO table_versions (name, slot, version)
+            VALUES (TG_TABLE_NAME, floor(random() * 16)::smallint, 1)
+            ON CONFLICT (name, slot) DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # Transition tables need a trigger per event
+    op.execute("DROP TRIGGER IF EXISTS student_bump_version ON student")
+    op.execute("""
+        CREATE TRIGGER student_bump_version_insert
+        AFTER INSERT ON student REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+    op.execute("""
+        CREATE TRIGGER student_bump_version_update
+        AFTER UPDATE ON student REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+    op.execute("""
+        CREATE TRIGGER student_bump_version_delete
+        AFTER DELETE ON student REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+    op.execute("""
+        CREATE TRIGGER student_bump_version_truncate
+        AFTER TRUNCATE ON student
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
+
+
+def downgrade():
+    for event in ("insert", "update", "delete", "truncate"):
+        op.execute(f"DROP TRIGGER IF EXISTS student_bump_version_{event} ON student")
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (name, slot, version)
+            VALUES (TG_TABLE_NAME, floor(random() * 16)::smallint, 1)
+            ON CONFLICT (name, slot) DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER student_bump_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON student
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()
+    """)
@@ -0,0 +1,56 @@
+"""spread table version counters over slots
+
+Revision ID: b6d2e8f41a93
+Revises: e93b1f7a4c20
+Create Date: 2026-10-18 17:40:26.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d2e8f41a93'
+down_revision = 'e93b1f7a4c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing counters become slot 0, so their sum and the ETags built from it carry on
+    op.add_column('table_versions', sa.Column('slot', sa.SmallInteger(), server_default='0',
+                                              nullable=False))
+    op.drop_constraint('table_versions_pkey', 'table_versions', type_='primary')
+    op.create_primary_key('table_versions_pkey', 'table_versions', ['name', 'slot'])
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (name, slot, version)
+            VALUES (TG_TABLE_NAME, floor(random() * 16)::smallint, 1)
+            ON CONFLICT (name, slot) DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (name, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (name) DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # Fold every counter into slot 0, so it never goes back to a value already served
+    op.execute("""
+        INSERT INTO table_versions (name, slot, version)
+        SELECT name, 0, sum(version) FROM table_versions GROUP BY name
+        ON CONFLICT (name, slot) DO UPDATE SET version = excluded.version
+    """)
+    op.execute("DELETE FROM table_versions WHERE slot <> 0")
+    op.drop_constraint('table_versions_pkey', 'table_versions', type_='primary')
+    op.create_primary_key('table_versions_pkey', 'table_versions', ['name'])
+    op.drop_column('table_versions', 'slot')
@@ -0,0 +1,31 @@
+"""add external_id natural key to student
+
+Revision ID: c7d08e5b3f91
+Revises: 9e4b2f7c1a03
+Create Date: 2026-10-18 12:04:10.552318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d08e5b3f91'
+down_revision = '9e4b2f7c1a03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('student', sa.Column('external_id', sa.String(length=64), nullable=True))
+    # Build the unique index without blocking writes to a large table
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_student_external_id'), 'student', ['external_id'],
+                        unique=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_student_external_id'), table_name='student',
+                      postgresql_concurrently=True)
+    op.drop_column('student', 'external_id')
@@ -0,0 +1,26 @@
+"""add row version to student for optimistic concurrency
+
+Revision ID: d41f6a2c8e57
+Revises: c7d08e5b3f91
+Create Date: 2026-10-18 13:21:47.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f6a2c8e57'
+down_revision = 'c7d08e5b3f91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A constant default is stored in the catalog, so existing rows are not rewritten
+    op.add_column('student', sa.Column('version', sa.Integer(), server_default='1',
+                                       nullable=False))
+
+
+def downgrade():
+    op.drop_column('student', 'version')
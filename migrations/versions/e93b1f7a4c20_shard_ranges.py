@@ -0,0 +1,32 @@
+"""add shard map for sharding students by id range
+
+Revision ID: e93b1f7a4c20
+Revises: d41f6a2c8e57
+Create Date: 2026-10-18 15:02:11.417385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e93b1f7a4c20'
+down_revision = 'd41f6a2c8e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Shard map of the student table; the shards' own tables are created with
+    # `flask shards init`
+    op.create_table(
+        'shard_ranges',
+        sa.Column('low', sa.BigInteger(), nullable=False),
+        sa.Column('high', sa.BigInteger(), nullable=False),
+        sa.Column('shard', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('low')
+    )
+
+
+def downgrade():
+    op.drop_table('shard_ranges')
@@ -0,0 +1,83 @@
+"""
+This module instruments the SQLAlchemy connection pool of a worker.
+
+The pool class records how long each checkout waited for a connection, so the
+pool can be sized from observed waits and timeouts instead of guesswork, and
+reports the usual occupancy gauges next to them.
+"""
+
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds, in milliseconds, of the checkout wait histogram buckets
+WAIT_MS_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that keeps checkout wait time and timeout metrics.
+
+    The wait covers getting a connection from the pool, including opening a new
+    one, but not the pre-ping. The metrics survive the pool being recreated
+    after a disconnect.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "histogram": dict.fromkeys(WAIT_MS_BUCKETS + ("+Inf",), 0),
+        }
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise
+        self.record(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.lock, pool.stats = self.lock, self.stats
+        return pool
+
+    def record(self, wait):
+        """
+        Add a checkout that waited wait seconds to the metrics.
+        """
+        wait_ms = wait * 1000
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds"] += wait
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+            bucket = next((b for b in WAIT_MS_BUCKETS if wait_ms <= b), "+Inf")
+            self.stats["histogram"][bucket] += 1
+
+    def metrics(self):
+        """
+        Return the pool gauges and checkout wait metrics as a dict.
+        """
+        with self.lock:
+            checkouts = self.stats["checkouts"]
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "max_overflow": self._max_overflow,
+                "checkouts": checkouts,
+                "timeouts": self.stats["timeouts"],
+                "mean_wait_ms": self.stats["wait_seconds"] * 1000 / checkouts if checkouts else 0,
+                "max_wait_ms": self.stats["max_wait_seconds"] * 1000,
+                "wait_ms_histogram": {str(b): n for b, n in self.stats["histogram"].items()},
+            }
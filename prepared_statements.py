@@ -0,0 +1,57 @@
+"""
+This module runs hot SQL statements as Postgres server-side prepared statements.
+
+Each statement is parsed once per physical connection with PREPARE and then run
+with EXECUTE, so Postgres skips parsing and can reuse a cached plan. Connections
+remember which statements they have prepared in their pool record, so a
+statement is prepared again only on a new connection.
+
+Prepared statements live in the server session. They must be turned off behind
+a proxy that hands each transaction a different server connection, such as
+PgBouncer in transaction pooling mode.
+"""
+
+import psycopg2
+
+INFO_KEY = "prepared_statements"
+
+
+class PreparedStatements:
+    """
+    A set of named statements, written with $1, $2, ... parameters.
+    """
+    def __init__(self, statements):
+        self.statements = statements
+
+    def prepare_all(self, dbapi_connection, connection_record):
+        """
+        Prepare every statement on a new connection.
+
+        Meant to be called from a pool "connect" event. If the statements cannot
+        be prepared yet, for example before the tables are created, they are
+        prepared on first use instead.
+        """
+        # PREPARE is not undone by a rollback, so record each one as it succeeds
+        prepared = connection_record.info[INFO_KEY] = set()
+        try:
+            with dbapi_connection.cursor() as cursor:
+                for name, sql in self.statements.items():
+                    cursor.execute(f"PREPARE {name} AS {sql}")
+                    prepared.add(name)
+            dbapi_connection.commit()
+        except psycopg2.Error:
+            dbapi_connection.rollback()
+
+    def execute(self, connection, name, *params):
+        """
+        Run a prepared statement on a SQLAlchemy connection and return its result.
+
+        The statement is prepared first if the connection was opened before
+        prepared statements were turned on.
+        """
+        prepared = connection.connection.info.setdefault(INFO_KEY, set())
+        if name not in prepared:
+            connection.exec_driver_sql(f"PREPARE {name} AS {self.statements[name]}")
+            prepared.add(name)
+        arguments = f" ({', '.join(['%s'] * len(params))})" if params else ""
+        return connection.exec_driver_sql(f"EXECUTE {name}{arguments}", params)
@@ -0,0 +1,151 @@
+"""
+This module sends the queries of read-only requests to Postgres read replicas.
+
+Writes always go to the primary. After a write the client is handed the primary's
+WAL position as a consistency token; a read that sends it back is only served by
+a replica that has replayed at least that far, and by the primary otherwise, so
+clients read their own writes.
+"""
+
+import itertools
+import threading
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm, text
+from sqlalchemy.exc import SQLAlchemyError
+
+# WAL position a server has reached: replayed on a replica, written on a primary
+REACHED_LSN = text(
+    "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+    "ELSE pg_current_wal_insert_lsn() END")
+
+
+def parse_lsn(token):
+    """
+    Turn a Postgres LSN such as "16/B374D848" into a comparable integer.
+
+    Raises ValueError when token is not an LSN.
+    """
+    high, low = token.split("/")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+class RoutingSession(SignallingSession):  # pylint: disable=too-few-public-methods
+    """
+    Session that runs every query on the shard or replica chosen for the current
+    request.
+    """
+    def get_bind(self, mapper=None, clause=None, **_kwargs):
+        engine = g.get("shard_engine") or g.get("read_engine") if has_app_context() else None
+        if engine is not None:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy extension whose sessions use RoutingSession.
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """
+    Picks the replica that serves a read.
+
+    replicas are bind names and get_engine returns the engine of one. strategy is
+    "round_robin", or "least_loaded" to prefer the replica whose pool has the
+    fewest checked out connections. Pools that do not count checkouts, such as
+    the NullPool used under transaction pooling, are taken in turns instead.
+    """
+    def __init__(self, replicas, get_engine, strategy):
+        self.replicas = replicas
+        self.get_engine = get_engine
+        self.strategy = strategy
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+        # Highest LSN each replica is known to have replayed; it never goes back
+        self.reached = dict.fromkeys(replicas, -1)
+        self.stats = {
+            "primary": 0,
+            "reads": dict.fromkeys(replicas, 0),
+            "lagging": dict.fromkeys(replicas, 0),
+            "errors": dict.fromkeys(replicas, 0),
+        }
+
+    def candidates(self):
+        """
+        Replicas in the order they should be tried.
+        """
+        pools = [self.get_engine(name).pool for name in self.replicas]
+        if self.strategy == "least_loaded" and all(hasattr(pool, "checkedout") for pool in pools):
+            loads = {name: pool.checkedout() for name, pool in zip(self.replicas, pools)}
+            return sorted(self.replicas, key=loads.get)
+        start = next(self.turn) % len(self.replicas)
+        return self.replicas[start:] + self.replicas[:start]
+
+    def choose(self, token=None):
+        """
+        Return the engine of a replica that has caught up with token, or None to
+        read from the primary.
+
+        A replica's position is only queried when the one last seen is behind the
+        token, and a replica that cannot be reached is skipped.
+        """
+        try:
+            min_lsn = parse_lsn(token) if token else -1
+        except ValueError:
+            min_lsn = None
+        for name in self.candidates() if min_lsn is not None else ():
+            engine = self.get_engine(name)
+            if self.reached[name] < min_lsn and self.catch_up(name, engine) < min_lsn:
+                self.count("lagging", name)
+                continue
+            self.count("reads", name)
+            return engine
+        with self.lock:
+            self.stats["primary"] += 1
+        return None
+
+    def catch_up(self, name, engine):
+        """
+        Refresh and return the LSN a replica has replayed.
+        """
+        try:
+            with engine.connect() as connection:
+                lsn = connection.execute(REACHED_LSN).scalar()
+            reached = parse_lsn(lsn) if lsn else -1
+        except SQLAlchemyError:
+            self.count("errors", name)
+            return -1
+        with self.lock:
+            self.reached[name] = max(self.reached[name], reached)
+            return self.reached[name]
+
+    def count(self, stat, name):
+        """
+        Count an event of a replica in the metrics.
+        """
+        with self.lock:
+            self.stats[stat][name] += 1
+
+    def metrics(self):
+        """
+        Return routing metrics as a dict.
+        """
+        with self.lock:
+            return {
+                "strategy": self.strategy,
+                "primary_reads": self.stats["primary"],
+                "replicas": {
+                    name: {
+                        "reads": self.stats["reads"][name],
+                        "lagging": self.stats["lagging"][name],
+                        "errors": self.stats["errors"][name],
+                        "pool": getattr(self.get_engine(name).pool, "metrics", dict)(),
+                    }
+                    for name in self.replicas
+                },
+            }
@@ -0,0 +1,153 @@
+"""
+This module adds negotiated gzip/brotli compression to Flask responses.
+
+Bodies below a size threshold are sent as is, streamed responses are compressed
+chunk by chunk, and compressed bodies of responses carrying an ETag can be
+cached so repeated polls do not pay for compression again.
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is an optional encoding
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "text/plain", "text/html"}
+
+
+class CompressedBodyCache:
+    """
+    Small thread-safe LRU cache of compressed bodies.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached body for key, or None.
+        """
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        """
+        Store a body, evicting the least recently used entry when full.
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class Compressor:
+    """
+    Incremental compressor for one response in the negotiated encoding.
+    """
+    def __init__(self, encoding, config):
+        self.encoding = encoding
+        if encoding == "br":
+            self.engine = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            self.engine = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """
+        Compress a chunk, flushing it so the client can decode it right away.
+        """
+        if self.encoding == "br":
+            return self.engine.process(data) + self.engine.flush()
+        return self.engine.compress(data) + self.engine.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """
+        Return the trailing bytes that end the compressed stream.
+        """
+        if self.encoding == "br":
+            return self.engine.finish()
+        return self.engine.flush()
+
+
+def negotiate_encoding():
+    """
+    Pick the best encoding the client accepts, or None.
+    """
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_stream(chunks, encoding, config):
+    """
+    Compress a streamed body chunk by chunk.
+    """
+    compressor = Compressor(encoding, config)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def init_app(app):
+    """
+    Register the compression hook and its defaults on the app.
+    """
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+    app.config.setdefault('COMPRESS_CACHE_SIZE', 128)
+    cache = CompressedBodyCache(app.config['COMPRESS_CACHE_SIZE'])
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or request.method == "HEAD"
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, app.config)
+            response.headers.pop("Content-Length", None)
+            response.headers["Content-Encoding"] = encoding
+            return response
+
+        body = response.get_data()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        etag = response.headers.get("ETag")
+        key = (etag, encoding, request.full_path, response.mimetype)
+        compressed = cache.get(key) if etag else None
+        if compressed is None:
+            compressor = Compressor(encoding, app.config)
+            compressed = compressor.compress(body) + compressor.finish()
+            if etag:
+                cache.put(key, compressed)
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    return app
@@ -0,0 +1,333 @@
+"""
+This module spreads the student table over several databases by id range.
+
+A shard map in the main database assigns every range of ids to one shard. Each
+shard draws new ids from its own sequence, confined to a range it leased from
+the map, so a new row always lands on the shard that owns its id without any
+coordination per insert.
+
+A range of ids can be moved to another shard while the application runs: its
+rows are copied over in batches, then locked on the old shard while the rows
+changed in the meantime are copied again and the map is switched, and finally
+deleted from the old shard. Workers cache the map for a few seconds; a lookup
+that misses reloads it, and a move waits out the cache before deleting anything.
+"""
+
+import bisect
+import itertools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+# Serializes leases and moves against each other, without blocking map reloads
+LOCK_MAP = "LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE"
+SEQUENCE_BOUNDS = text(
+    "SELECT seqmin, seqmax FROM pg_sequence WHERE seqrelid = CAST(:seq AS regclass)")
+RESTART_SEQUENCE = (
+    "ALTER SEQUENCE {seq} MINVALUE {low} MAXVALUE {last} START WITH {low} RESTART WITH {low}")
+
+
+def in_ranges(column, id_ranges):
+    """
+    WHERE clause selecting the ids in any of the given (low, high) ranges.
+    """
+    return or_(*(and_(column >= low, column < high) for low, high in id_ranges))
+
+
+class ShardRouter:  # pylint: disable=too-many-instance-attributes
+    """
+    Finds the shard that owns a student id and runs queries on every shard.
+
+    shards are bind names and get_engine returns the engine of one, or that of the
+    main database, which holds the shard map, for None. table is the sharded table
+    and ranges the shard map, with low, high and shard columns; a range holds the
+    ids from low up to, but not including, high.
+    """
+    def __init__(self, shards, get_engine, table, ranges, **options):
+        self.shards = shards
+        self.get_engine = get_engine
+        self.table = table
+        self.ranges = ranges
+        self.range_size = options.get("range_size", 1000000)
+        self.map_ttl = options.get("map_ttl", 1.0)
+        self.executor = ThreadPoolExecutor(
+            options.get("workers") or 4 * len(shards), "shard") if shards else None
+        self.turn = itertools.count()
+        self.lock = threading.Lock()
+        # (low, high, shard) sorted by low, and when it was read
+        self.map = []
+        self.loaded_at = None
+        self.stats = {
+            "fan_outs": 0,
+            "map_reloads": 0,
+            "leases": 0,
+            "moves": 0,
+            "routed": dict.fromkeys(shards, 0),
+        }
+
+    def load(self):
+        """
+        Reload the shard map from the main database.
+        """
+        columns = self.ranges.c
+        with self.get_engine(None).connect() as connection:
+            rows = connection.execute(
+                select(columns.low, columns.high, columns.shard).order_by(columns.low)).all()
+        with self.lock:
+            self.map = [tuple(row) for row in rows]
+            self.loaded_at = time.monotonic()
+            self.stats["map_reloads"] += 1
+        return self.map
+
+    def current_map(self, refresh=False):
+        """
+        The cached shard map, reloaded when asked to or once it is SHARD_MAP_TTL old.
+        """
+        if refresh or self.loaded_at is None or time.monotonic() - self.loaded_at >= self.map_ttl:
+            return self.load()
+        return self.map
+
+    def shard_for(self, student_id, refresh=False):
+        """
+        Name of the shard that owns an id, or None when no shard does.
+        """
+        id_map = self.current_map(refresh)
+        index = bisect.bisect_right(id_map, (student_id, math.inf)) - 1
+        if index < 0 or student_id >= id_map[index][1]:
+            return None
+        shard = id_map[index][2]
+        with self.lock:
+            self.stats["routed"][shard] += 1
+        return shard
+
+    def next_shard(self):
+        """
+        Shard that stores the next new row, taking turns.
+        """
+        return self.shards[next(self.turn) % len(self.shards)]
+
+    def placements(self):
+        """
+        Engine and (low, high) id ranges of every shard that owns ids.
+        """
+        id_map = self.current_map()
+        placements = []
+        for shard in self.shards:
+            id_ranges = [(low, high) for low, high, name in id_map if name == shard]
+            if id_ranges:
+                placements.append((self.get_engine(shard), id_ranges))
+        return placements
+
+    def fan_out(self, work):
+        """
+        Run work(engine, id_ranges) for every shard in parallel and return the results.
+
+        id_ranges are the (low, high) ranges the shard map gives the shard, which a
+        query should be limited to: during a move the rows exist on two shards.
+        Shards that own no ids are skipped.
+        """
+        futures = [self.executor.submit(work, engine, id_ranges)
+                   for engine, id_ranges in self.placements()]
+        with self.lock:
+            self.stats["fan_outs"] += 1
+        return [future.result() for future in futures]
+
+    def sequence_bounds(self, shard):
+        """
+        Lowest and highest id the shard's sequence hands out, and the sequence name.
+        """
+        with self.get_engine(shard).connect() as connection:
+            sequence = connection.execute(
+                select(func.pg_get_serial_sequence(self.table.name, "id"))).scalar()
+            low, last = connection.execute(SEQUENCE_BOUNDS, {"seq": sequence}).one()
+        return low, last, sequence
+
+    def lease(self, shard):
+        """
+        Give a shard the next unused range of ids and point its id sequence at it.
+
+        The range is recorded in the map before the sequence can hand out its ids.
+        Returns the range as (low, high).
+        """
+        columns = self.ranges.c
+        with self.get_engine(None).begin() as connection:
+            connection.execute(text(LOCK_MAP.format(table=self.ranges.name)))
+            low = connection.execute(select(func.coalesce(func.max(columns.high), 1))).scalar()
+            high = low + self.range_size
+            connection.execute(self.ranges.insert().values(low=low, high=high, shard=shard))
+        _, _, sequence = self.sequence_bounds(shard)
+        with self.get_engine(shard).begin() as connection:
+            connection.execute(text(RESTART_SEQUENCE.format(seq=sequence, low=low, last=high - 1)))
+        with self.lock:
+            self.stats["leases"] += 1
+        self.load()
+        return low, high
+
+    def assign(self, low, high, shard):
+        """
+        Give the ids from low up to high to a shard in the map, splitting the ranges
+        they were part of.
+        """
+        columns = self.ranges.c
+        overlap = and_(columns.low < high, columns.high > low)
+        with self.get_engine(None).begin() as connection:
+            connection.execute(text(LOCK_MAP.format(table=self.ranges.name)))
+            replaced = connection.execute(
+                select(columns.low, columns.high, columns.shard).where(overlap)).all()
+            connection.execute(self.ranges.delete().where(overlap))
+            pieces = [{"low": low, "high": high, "shard": shard}]
+            for old_low, old_high, owner in replaced:
+                if old_low < low:
+                    pieces.append({"low": old_low, "high": low, "shard": owner})
+                if old_high > high:
+                    pieces.append({"low": high, "high": old_high, "shard": owner})
+            connection.execute(self.ranges.insert(), pieces)
+        self.load()
+
+    def source_of(self, low, high):
+        """
+        The one shard that owns every id from low up to high.
+
+        Raises ValueError when the ids are not all owned, or owned by several shards.
+        """
+        position, owners = low, set()
+        for range_low, range_high, shard in self.current_map(refresh=True):
+            if range_high <= position or range_low >= high:
+                continue
+            if range_low > position:
+                break
+            owners.add(shard)
+            position = range_high
+        if position < high or len(owners) != 1:
+            raise ValueError(f"Ids {low} to {high - 1} are not all owned by one shard")
+        return owners.pop()
+
+    def copy(self, connection, rows):
+        """
+        Write rows to a shard, overwriting the copies it already has.
+        """
+        insert = pg_insert(self.table).values([row._asdict() for row in rows])
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[self.table.c.id],
+            set_={column.name: insert.excluded[column.name]
+                  for column in self.table.c if column.name != "id"}))
+
+    def move(self, low, high, target, batch_size=1000, echo=print):
+        """
+        Move the ids from low up to high, with their rows, to the target shard.
+
+        Reads and writes of other ids are not held up. Writes to the moved rows
+        wait while the last changes are copied and the workers' maps expire, then
+        find the rows gone and are retried on the target shard. The ids a shard is
+        still handing out to new rows cannot be moved.
+
+        Returns the number of rows moved.
+        """
+        if not low < high or target not in self.shards:
+            raise ValueError("Give a non-empty id range and one of the shards")
+        source = self.source_of(low, high)
+        seq_low, seq_last, _ = self.sequence_bounds(source)
+        if source == target or seq_low < high and seq_last >= low:
+            raise ValueError(f"Ids {low} to {high - 1} cannot be moved from {source} to {target}")
+
+        in_move = and_(self.table.c.id >= low, self.table.c.id < high)
+        self.copy_batches(source, target, in_move, batch_size, echo)
+        moved = self.switch(source, target, (low, high), batch_size, echo)
+        with self.lock:
+            self.stats["moves"] += 1
+        return moved
+
+    def copy_batches(self, source, target, in_move, batch_size, echo):
+        """
+        Copy the rows being moved in id order, one transaction per batch.
+        """
+        columns = self.table.c
+        after, copied = None, 0
+        while True:
+            query = select(self.table).where(in_move).order_by(columns.id).limit(batch_size)
+            if after is not None:
+                query = query.where(columns.id > after)
+            with self.get_engine(source).connect() as connection:
+                rows = connection.execute(query).all()
+            if not rows:
+                return
+            with self.get_engine(target).begin() as connection:
+                self.copy(connection, rows)
+            after, copied = rows[-1].id, copied + len(rows)
+            echo(f"Copied {copied} rows from {source} to {target}.")
+
+    def switch(self, source, target, id_range, batch_size, echo):
+        """
+        Lock the rows being moved, copy the ones changed or deleted since they were
+        copied, give their ids to the target and delete them from the source.
+
+        Rows are locked and compared with the target's copies one batch of ids at a
+        time, in the one transaction that keeps them locked until they are deleted.
+        """
+        columns = self.table.c
+        in_move = and_(columns.id >= id_range[0], columns.id < id_range[1])
+        after, locked, changed = None, 0, 0
+        with self.get_engine(source).begin() as source_connection:
+            while True:
+                query = select(self.table).where(in_move).order_by(columns.id).limit(batch_size)
+                window = in_move
+                if after is not None:
+                    query = query.where(columns.id > after)
+                    window = and_(window, columns.id > after)
+                rows = source_connection.execute(query.with_for_update()).all()
+                # The last batch also covers the copies of any rows deleted after it
+                if len(rows) == batch_size:
+                    window = and_(window, columns.id <= rows[-1].id)
+                locked, changed = locked + len(rows), changed + self.catch_up(target, rows, window)
+                if len(rows) < batch_size:
+                    break
+                after = rows[-1].id
+            self.assign(*id_range, target)
+            echo(f"Copied {changed} changed rows and gave the ids to {target}.")
+            # Workers still using the old map read the old rows until it expires
+            time.sleep(self.map_ttl)
+            source_connection.execute(self.table.delete().where(in_move))
+        echo(f"Deleted {locked} rows from {source}.")
+        return locked
+
+    def catch_up(self, target, rows, window):
+        """
+        Make the target's copies of the ids in window match rows, copying the rows
+        whose version differs and deleting the copies of rows no longer there.
+
+        Returns the number of rows copied.
+        """
+        columns = self.table.c
+        with self.get_engine(target).begin() as connection:
+            copies = dict(connection.execute(
+                select(columns.id, columns.version).where(window)).all())
+            changed = [row for row in rows if copies.pop(row.id, None) != row.version]
+            if changed:
+                self.copy(connection, changed)
+            if copies:
+                connection.execute(self.table.delete().where(columns.id.in_(list(copies))))
+        return len(changed)
+
+    def metrics(self):
+        """
+        Return sharding metrics as a dict.
+        """
+        with self.lock:
+            return {
+                "fan_outs": self.stats["fan_outs"],
+                "map_reloads": self.stats["map_reloads"],
+                "leases": self.stats["leases"],
+                "moves": self.stats["moves"],
+                "shards": {
+                    name: {
+                        "ranges": sum(1 for _, _, shard in self.map if shard == name),
+                        "routed": self.stats["routed"][name],
+                        "pool": getattr(self.get_engine(name).pool, "metrics", dict)(),
+                    }
+                    for name in self.shards
+                },
+            }
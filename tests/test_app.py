@@ -1,7 +1,19 @@
+import gzip
+import json
+import tempfile
+import threading
+import time
 import unittest
 import os
-from app import app, db, Student
+import psycopg2
+from app import (app, db, encode_cursor, FastJSONEncoder, replica_router, Student,
+                 write_behind_log)
+from read_routing import ReplicaRouter
+from write_behind import WriteBehindLog
 from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
 
 class TestStudentAPI(unittest.TestCase):
 
@@ -98,5 +110,628 @@ class TestStudentAPI(unittest.TestCase):
         deleted_student = Student.query.get(student.id)
         self.assertIsNone(deleted_student)
 
+    def test_get_students_paginated(self):
+        """Test walking the student list with limit and the next-page cursor."""
+        with app.app_context():
+            for i in range(5):
+                db.session.add(Student(name=f"Student {i}", age=20 + i))
+            db.session.commit()
+
+        response = self.app.get('/students?limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json), 2)
+        self.assertIn('rel="next"', response.headers['Link'])
+
+        seen = [s['id'] for s in response.json]
+        while 'Link' in response.headers:
+            next_url = response.headers['Link'].split(';')[0].strip('<>')
+            response = self.app.get(next_url)
+            seen.extend(s['id'] for s in response.json)
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_get_students_invalid_cursor(self):
+        """Test that a malformed cursor is rejected."""
+        response = self.app.get('/students?after=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+        # true would pass for an integer id, as bool is a subclass of int
+        response = self.app.get(f'/students?after={encode_cursor(["id", True])}')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_students_ndjson_stream(self):
+        """Test streaming the student list as NDJSON."""
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Student(name=f"Student {i}", age=20 + i))
+            db.session.commit()
+
+        response = self.app.get('/students', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+
+        response = self.app.get('/students?stream=1')
+        self.assertEqual(len(response.json), 3)
+
+    def test_get_students_sparse_fields(self):
+        """Test limiting the listed and single student to the requested fields."""
+        with app.app_context():
+            student = Student(name="Dana White", age=19)
+            db.session.add(student)
+            db.session.commit()
+            student_id = student.id
+
+        response = self.app.get('/students?fields=id,name')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [{'id': student_id, 'name': 'Dana White'}])
+
+        response = self.app.get(f'/students/{student_id}?fields=age')
+        self.assertEqual(response.json, {'age': 19})
+
+        response = self.app.get('/students?fields=password')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_students_core_read_path(self):
+        """Test that the Core read path lists the same students as the ORM path."""
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Student(name=f"Student {i}", age=20 + i))
+            db.session.commit()
+
+        orm_response = self.app.get('/students')
+        app.config['STUDENTS_READ_PATH'] = 'core'
+        try:
+            core_response = self.app.get('/students')
+        finally:
+            app.config['STUDENTS_READ_PATH'] = 'orm'
+        self.assertEqual(core_response.json, orm_response.json)
+
+    def test_get_students_not_modified(self):
+        """Test that polling with a current ETag returns 304 until the table changes."""
+        response = self.app.get('/students')
+        etag = response.headers['ETag']
+
+        response = self.app.get('/students', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.app.post('/students', json={"name": "Eve Adams", "age": 20})
+        response = self.app.get('/students', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_students_gzip(self):
+        """Test that large listings are gzip-compressed when the client accepts it."""
+        with app.app_context():
+            for i in range(50):
+                db.session.add(Student(name=f"Student {i}", age=20))
+            db.session.commit()
+
+        response = self.app.get('/students', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 50)
+
+        response = self.app.get('/students?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_get_students_filtered_and_sorted(self):
+        """Test filtering by age and name prefix and sorting by age."""
+        with app.app_context():
+            for name, age in [("Ann", 19), ("Andy", 22), ("Bea", 21), ("Cal", 22)]:
+                db.session.add(Student(name=name, age=age))
+            db.session.commit()
+
+        response = self.app.get('/students?age_min=21&sort=-age')
+        self.assertEqual([s['age'] for s in response.json], [22, 22, 21])
+
+        response = self.app.get('/students?name_prefix=An&sort=name')
+        self.assertEqual([s['name'] for s in response.json], ['Andy', 'Ann'])
+
+        response = self.app.get('/students?sort=age&limit=1')
+        next_url = response.headers['Link'].split(';')[0].strip('<>')
+        response = self.app.get(next_url)
+        self.assertEqual(response.json[0]['age'], 21)
+
+        response = self.app.get('/students?sort=email')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_students_bulk(self):
+        """Test creating a batch of students, skipping the invalid ones."""
+        new_students = [
+            {"name": "Fay Green", "age": 20},
+            {"name": "", "age": 21},
+            {"name": "Gus Hall", "age": 22},
+        ]
+
+        response = self.app.post('/students/bulk', json=new_students)
+        self.assertEqual(response.status_code, 201)
+        ids = response.json['ids']
+        self.assertIsNone(ids[1])
+        self.assertLess(ids[0], ids[2])
+        self.assertEqual(response.json['errors'][0]['index'], 1)
+        self.assertEqual(self.app.get(f'/students/{ids[2]}').json['name'], 'Gus Hall')
+
+        response = self.app.post('/students/bulk?atomic=1', json=new_students)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.app.get('/students').json), 2)
+
+    def test_age_out_of_integer_range(self):
+        """Test that ages a Postgres integer cannot hold are rejected with 400, not 500."""
+        response = self.app.post('/students/bulk', json=[{"name": "Ann Bo", "age": 2 ** 31},
+                                                         {"name": "Cy Dee", "age": 30}])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['errors'][0]['index'], 0)
+        student_id = response.json['ids'][1]
+
+        self.assertEqual(self.app.post('/students', json={"name": "Ann Bo", "age": -2 ** 31 - 1})
+                         .status_code, 400)
+        self.assertEqual(self.app.patch(f'/students/{student_id}', json={"age": 2 ** 40},
+                                        headers={'If-Match': '"v1"'}).status_code, 400)
+        response = self.app.patch('/students?all=1', json={"increment": {"age": 2 ** 31 - 1}})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get(f'/students/{student_id}').json['age'], 30)
+
+    def test_import_students_csv(self):
+        """Test importing students from a CSV upload."""
+        body = "name,age\nHal Ives,20\nIda Jones,21\n"
+
+        response = self.app.post('/students/import', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'inserted': 2, 'updated': 0})
+        self.assertEqual(len(self.app.get('/students').json), 2)
+
+    def test_import_students_ndjson(self):
+        """Test that an NDJSON import updates rows that name an existing id."""
+        with app.app_context():
+            student = Student(name="Jo King", age=30)
+            db.session.add(student)
+            db.session.commit()
+            student_id = student.id
+
+        body = (f'{{"id": {student_id}, "name": "Jo King", "age": 31}}\n'
+                '{"name": "Kai Long", "age": 22}\n')
+        response = self.app.post('/students/import', data=body,
+                                 content_type='application/x-ndjson')
+        self.assertEqual(response.json, {'inserted': 1, 'updated': 1})
+        self.assertEqual(self.app.get(f'/students/{student_id}').json['age'], 31)
+
+        body = (f'{{"id": {student_id}, "name": "Jo King", "age": 32}}\n'
+                f'{{"id": {student_id}, "name": "Jo King", "age": 33}}\n')
+        response = self.app.post('/students/import', data=body,
+                                 content_type='application/x-ndjson')
+        self.assertEqual(response.json, {'inserted': 0, 'updated': 1})
+        self.assertEqual(self.app.get(f'/students/{student_id}').json['age'], 33)
+
+        response = self.app.post('/students/import', data='{"name": "Lu", "age": "x"}\n',
+                                 content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_student_returns_created_row(self):
+        """Test that a create returns the stored student and its Location."""
+        response = self.app.post('/students', json={"name": "Eve Fox", "age": 23})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['name'], 'Eve Fox')
+        self.assertTrue(response.headers['Location'].endswith(f"/students/{response.json['id']}"))
+        self.assertEqual(self.app.get(response.headers['Location']).json, response.json)
+
+    def test_replace_student_if_match(self):
+        """Test that a replace needs the current ETag and bumps the version."""
+        created = self.app.post('/students', json={"name": "Gil Hart", "age": 20})
+        location = created.headers['Location']
+        etag = self.app.get(location).headers['ETag']
+        update = {"name": "Gil Hart", "age": 21}
+
+        self.assertEqual(self.app.put(location, json=update).status_code, 428)
+
+        response = self.app.put(location, json=update, headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['version'], 2)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        stale = self.app.put(location, json={"name": "Gil", "age": 22},
+                             headers={'If-Match': etag})
+        self.assertEqual(stale.status_code, 412)
+        self.assertEqual(stale.headers['ETag'], response.headers['ETag'])
+        self.assertEqual(self.app.get(location).json['age'], 21)
+
+    def test_patch_student(self):
+        """Test that a merge patch changes only the given fields, and no-op patches write nothing."""
+        created = self.app.post('/students', json={"name": "Hal Ide", "age": 20})
+        location = created.headers['Location']
+        headers = {'If-Match': '"v1"', 'Content-Type': 'application/merge-patch+json'}
+
+        response = self.app.patch(location, data=json.dumps({"age": 21}), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json['name'], response.json['age']), ('Hal Ide', 21))
+        self.assertEqual(response.json['version'], 2)
+
+        headers['If-Match'] = response.headers['ETag']
+        response = self.app.patch(location, data=json.dumps({"age": 21}), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['version'], 2)
+
+        response = self.app.patch(location, data=json.dumps({"name": None}), headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_delete_student_if_match(self):
+        """Test that a delete with a stale ETag is refused."""
+        created = self.app.post('/students', json={"name": "Ivy Hill", "age": 20})
+        location = created.headers['Location']
+
+        response = self.app.delete(location, headers={'If-Match': '"v7"'})
+        self.assertEqual(response.status_code, 412)
+        response = self.app.delete(location, headers={'If-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.app.get(location).status_code, 404)
+
+    def test_add_student_group_commit(self):
+        """Test that concurrent creates are batched when group commit is on."""
+        statuses = []
+
+        def create(i):
+            client = app.test_client()
+            response = client.post('/students', json={"name": f"Student {i}", "age": 20})
+            statuses.append(response.status_code)
+
+        app.config['STUDENTS_GROUP_COMMIT'] = True
+        try:
+            threads = [threading.Thread(target=create, args=(i,)) for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            app.config['STUDENTS_GROUP_COMMIT'] = False
+
+        self.assertEqual(statuses, [201] * 20)
+        self.assertEqual(len(self.app.get('/students').json), 20)
+        metrics = self.app.get('/metrics').json['group_commit']
+        self.assertLess(metrics['batches'], metrics['items'])
+
+    def test_group_commit_connection_lost_at_commit(self):
+        """Test that a batch whose commit outcome is unknown fails with 503 and is not re-inserted."""
+        dropped = []
+
+        def drop_after_commit(session):
+            if not dropped:
+                dropped.append(session)
+                raise OperationalError("COMMIT", {}, psycopg2.OperationalError(
+                    "server closed the connection unexpectedly"))
+
+        event.listen(db.session, "after_commit", drop_after_commit)
+        app.config['STUDENTS_GROUP_COMMIT'] = True
+        try:
+            response = self.app.post('/students', json={"name": "Max Bell", "age": 20})
+        finally:
+            app.config['STUDENTS_GROUP_COMMIT'] = False
+            event.remove(db.session, "after_commit", drop_after_commit)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(len(self.app.get('/students?name=Max Bell').json), 1)
+
+    def test_fast_json_encoder_matches_stdlib(self):
+        """Test that the orjson encoder writes the same bytes as the stdlib one, floats aside."""
+        payload = [{"id": 1, "name": "Zoë Ng 😀", "age": 20, "external_id": None, "version": 1},
+                   {2: True, "tab": "a\tb\x7f"}]
+        fast = FastJSONEncoder(separators=(",", ":")).encode(payload)
+        self.assertEqual(fast, json.JSONEncoder(separators=(",", ":")).encode(payload))
+
+        # Floats keep their value, but NaN and Infinity, which are not JSON, become null
+        floats = {"score": 1e16, "small": 1e-7, "nan": float("nan"), "inf": float("inf")}
+        fast = FastJSONEncoder(separators=(",", ":")).encode(floats)
+        self.assertEqual(json.loads(fast), {"score": 1e16, "small": 1e-7, "nan": None, "inf": None})
+
+    def test_pool_metrics(self):
+        """Test that connection checkouts show up in the pool metrics."""
+        self.app.get('/students')
+        metrics = self.app.get('/metrics').json['pool']
+        self.assertGreaterEqual(metrics['checkouts'], 1)
+        self.assertEqual(metrics['checked_out'], 0)
+        self.assertEqual(sum(metrics['wait_ms_histogram'].values()), metrics['checkouts'])
+
+    def test_replica_router_consistency_token(self):
+        """Test that a replica is only chosen once it has reached the client's token."""
+        with app.app_context():
+            engine = db.engine
+            router = ReplicaRouter(["replica0"], lambda name: engine, "round_robin")
+            lsn = db.session.execute(db.text("SELECT pg_current_wal_insert_lsn()")).scalar()
+
+            self.assertIs(router.choose(), engine)
+            self.assertIs(router.choose(lsn), engine)
+            self.assertIsNone(router.choose("FFFFFFFF/0"))
+            self.assertIsNone(router.choose("not-an-lsn"))
+            metrics = router.metrics()
+        self.assertEqual(metrics['primary_reads'], 2)
+        self.assertEqual(metrics['replicas']['replica0']['lagging'], 1)
+
+    def test_replica_router_least_loaded_without_pool_counts(self):
+        """Test that least_loaded takes turns when the pools cannot count checkouts."""
+        engines = {name: create_engine(os.getenv("TEST_DATABASE_URL"), poolclass=NullPool)
+                   for name in ("replica0", "replica1")}
+        router = ReplicaRouter(list(engines), engines.get, "least_loaded")
+        self.assertEqual({router.candidates()[0] for _ in range(4)}, set(engines))
+
+    def test_request_deadline(self):
+        """Test that an exhausted or malformed X-Request-Deadline is refused up front."""
+        response = self.app.get('/students', headers={'X-Request-Deadline': '0'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        response = self.app.get('/students', headers={'X-Request-Deadline': 'soon'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.app.get('/students', headers={'X-Request-Deadline': '1000'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_request_deadline_after_commit(self):
+        """Test that a write committed within its budget succeeds however long the rest takes."""
+        slow_commit = lambda session: time.sleep(0.2)
+        event.listen(db.session, "after_commit", slow_commit)
+        replica_router.replicas = ["replica0"]
+        try:
+            response = self.app.post('/students', json={"name": "Lea Moss", "age": 20},
+                                     headers={'X-Request-Deadline': '100'})
+        finally:
+            replica_router.replicas = []
+            event.remove(db.session, "after_commit", slow_commit)
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('X-Consistency-Token', response.headers)
+
+    def test_prepared_statements_switch(self):
+        """Test that reads return the same students with prepared statements on and off."""
+        created = self.app.post('/students', json={"name": "Ike Jones", "age": 24}).json
+        responses = []
+        for prepared in (True, False):
+            app.config['PREPARED_STATEMENTS'] = prepared
+            try:
+                responses.append((self.app.get(f"/students/{created['id']}").json,
+                                  self.app.get('/students').json))
+            finally:
+                app.config['PREPARED_STATEMENTS'] = True
+        self.assertEqual(responses[0], responses[1])
+        self.assertEqual(responses[0][0], created)
+
+        # Ids outside the integer range of the prepared parameter are not found, not errors
+        self.assertEqual(self.app.get('/students/99999999999').status_code, 404)
+        after = encode_cursor(["id", 99999999999])
+        self.assertEqual(self.app.get(f'/students?after={after}').json, [])
+
+        # ?fields= selects only the requested columns rather than the prepared full row
+        statements = []
+        with app.app_context():
+            engine = db.engine
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            self.assertEqual(self.app.get(f"/students/{created['id']}?fields=name").json,
+                             {"name": "Ike Jones"})
+            self.assertEqual(self.app.get('/students?fields=name').json, [{"name": "Ike Jones"}])
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        reads = [s for s in statements if "FROM student " in s]
+        self.assertEqual(len(reads), 2)
+        self.assertFalse(any("EXECUTE" in s or "age" in s for s in reads))
+
+    def test_retry_transient_errors(self):
+        """Test that a dropped connection is retried, unless a batch had already committed."""
+        first = self.app.post('/students', json={"name": "Jan Kerr", "age": 20}).json
+        second = self.app.post('/students', json={"name": "Kim Lowe", "age": 20}).json
+        before = self.app.get('/metrics').json['retries']['connection']
+        drop = {}
+
+        def drop_connection(cursor, statement, parameters, context):
+            if drop and drop["match"] in statement:
+                drop["seen"] += 1
+                if drop["seen"] == drop["at"]:
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "do_execute", drop_connection)
+        try:
+            drop.update(match="student", at=1, seen=0)
+            response = self.app.get(f"/students/{first['id']}")
+            self.assertEqual(response.status_code, 200)
+
+            drop.update(match="UPDATE", at=2, seen=0)
+            response = self.app.patch('/students?all=1&batch_size=1',
+                                      json={"increment": {"age": 1}})
+            self.assertEqual(response.status_code, 503)
+        finally:
+            event.remove(engine, "do_execute", drop_connection)
+
+        self.assertEqual(self.app.get(f"/students/{first['id']}").json['age'], 21)
+        self.assertEqual(self.app.get(f"/students/{second['id']}").json['age'], 20)
+        after = self.app.get('/metrics').json['retries']['connection']
+        self.assertEqual(after['recovered'] - before['recovered'], 1)
+        self.assertEqual(after['given_up'] - before['given_up'], 1)
+
+    def test_add_student_idempotency_key(self):
+        """Test that a retried create with the same Idempotency-Key is not written twice."""
+        headers = {'Idempotency-Key': 'create-mia-1'}
+        new_student = {"name": "Mia North", "age": 20}
+
+        first = self.app.post('/students', json=new_student, headers=headers)
+        retry = self.app.post('/students', json=new_student, headers=headers)
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.json, first.json)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.app.get('/students?name=Mia North').json), 1)
+
+    def test_upsert_students(self):
+        """Test inserting, updating and skipping unchanged students by external_id."""
+        batch = [
+            {"external_id": "sis-1", "name": "Ned Olsen", "age": 20},
+            {"external_id": "sis-2", "name": "Ola Park", "age": 21},
+        ]
+        response = self.app.put('/students:upsert', json=batch)
+        self.assertEqual(response.json, {'inserted': 2, 'updated': 0, 'unchanged': 0})
+
+        batch[1]["age"] = 22
+        response = self.app.put('/students:upsert', json=batch)
+        self.assertEqual(response.json, {'inserted': 0, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(self.app.get('/students?name=Ola Park').json[0]['age'], 22)
+
+        # Resending the same students leaves the listing's ETag alone
+        etag = self.app.get('/students').headers['ETag']
+        response = self.app.put('/students:upsert', json=batch)
+        self.assertEqual(response.json, {'inserted': 0, 'updated': 0, 'unchanged': 2})
+        self.assertEqual(self.app.get('/students').headers['ETag'], etag)
+
+    def test_update_and_delete_students_by_filter(self):
+        """Test set-based updates and deletes with dry runs and the safety limit."""
+        with app.app_context():
+            for i in range(6):
+                db.session.add(Student(name=f"Student {i}", age=20 if i < 4 else 25))
+            db.session.commit()
+
+        response = self.app.patch('/students?age=20&dry_run=1', json={"increment": {"age": 1}})
+        self.assertEqual(response.json, {'matched': 4})
+
+        # An oversized filter is refused before a single row is written
+        statements = []
+        with app.app_context():
+            engine = db.engine
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            response = self.app.patch('/students?age=20&max_affected=3',
+                                      json={"increment": {"age": 1}})
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(any(s.startswith("UPDATE") for s in statements))
+
+        response = self.app.patch('/students?age=20&batch_size=3', json={"increment": {"age": 1}})
+        self.assertEqual(response.json, {'updated': 4})
+        self.assertEqual(len(self.app.get('/students?age=21').json), 4)
+
+        response = self.app.delete('/students?age_min=25')
+        self.assertEqual(response.json, {'deleted': 2})
+
+        # A write that matches nothing, or a dry run spelled wrong, changes nothing
+        etag = self.app.get('/students').headers['ETag']
+        response = self.app.patch('/students?age=99', json={"increment": {"age": 1}})
+        self.assertEqual(response.json, {'updated': 0})
+        response = self.app.delete('/students?age=21&dry_run=yes')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.app.get('/students').headers['ETag'], etag)
+
+        response = self.app.delete('/students')
+        self.assertEqual(response.status_code, 400)
+
+        # A mistyped filter or a malformed body is refused, not ignored
+        response = self.app.delete('/students?age=21&nmae=Bob')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.patch('/students?age=21', json={"set": [1]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.app.get('/students?age=21').json), 4)
+
+    def test_batched_write_stops_at_max_affected(self):
+        """Test that rows inserted during a batched write cannot take it past max_affected."""
+        with app.app_context():
+            for i in range(3):
+                db.session.add(Student(name=f"Student {i}", age=20))
+            db.session.commit()
+            engine = db.engine
+
+        other = create_engine(os.getenv("TEST_DATABASE_URL"), poolclass=NullPool)
+        inserted = []
+
+        def insert_concurrently(conn, cursor, statement, *args):
+            if statement.startswith("UPDATE") and not inserted:
+                inserted.append(statement)
+                with other.begin() as connection:
+                    connection.execute(db.text(
+                        "INSERT INTO student (name, age) VALUES ('Late', 20), ('Later', 20)"))
+
+        event.listen(engine, "before_cursor_execute", insert_concurrently)
+        try:
+            response = self.app.patch('/students?age=20&max_affected=3&batch_size=2',
+                                      json={"set": {"age": 30}})
+        finally:
+            event.remove(engine, "before_cursor_execute", insert_concurrently)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['updated'], 3)
+        self.assertEqual(len(self.app.get('/students?age=30').json), 3)
+        self.assertEqual(len(self.app.get('/students?age=20').json), 2)
+
+    def test_add_student_write_behind(self):
+        """Test that a write-behind create is accepted with 202 and applied later."""
+        write_behind_log.options['directory'] = tempfile.mkdtemp()
+        app.config['STUDENTS_WRITE_BEHIND'] = True
+        try:
+            response = self.app.post('/students', json={"name": "Pia Quinn", "age": 20})
+        finally:
+            app.config['STUDENTS_WRITE_BEHIND'] = False
+        self.assertEqual(response.status_code, 202)
+
+        status_url = response.headers['Location']
+        for _ in range(50):
+            status = self.app.get(status_url).json
+            if status['status'] != 'pending':
+                break
+            time.sleep(0.1)
+        self.assertEqual(status['status'], 'applied')
+        self.assertEqual(self.app.get(f"/students/{status['id']}").json['name'], 'Pia Quinn')
+
+    def test_write_behind_log_owned_elsewhere(self):
+        """Test that a log locked by another owner is not started and leaks no handle."""
+        directory = tempfile.mkdtemp()
+        owner = WriteBehindLog(directory, lambda batch: None, 0.001, 10)
+        self.assertTrue(owner.start())
+        other = WriteBehindLog(directory, lambda batch: None, 0.001, 10)
+        self.assertFalse(other.start())
+        self.assertIsNone(other.file)
+        self.assertEqual(other.metrics()['locked_out'], 1)
+        with self.assertRaises(RuntimeError):
+            other.append({"name": "Ray Sun", "age": 20})
+
+        # Ids handed out by another worker read as pending until their outcome is stored
+        tracking_id = owner.append({"name": "Ray Sun", "age": 20})
+        self.assertEqual(self.app.get(f'/students/writes/{tracking_id}').json['status'], 'pending')
+        old_id = f"{int(time.time()) - 10 ** 6:x}-{tracking_id.partition('-')[2]}"
+        self.assertEqual(self.app.get(f'/students/writes/{old_id}').status_code, 404)
+        self.assertEqual(self.app.get('/students/writes/not-an-id').status_code, 404)
+
+    def test_write_behind_replays_after_truncation(self):
+        """Test that writes queued after the log was emptied are replayed on restart."""
+        directory = tempfile.mkdtemp()
+        offline = threading.Event()
+
+        def apply(batch):
+            if offline.is_set() or any(item['name'] != 'Applied' for _, item in batch):
+                raise RuntimeError("database unavailable")
+
+        log = WriteBehindLog(directory, apply, 0.001, 1, retry_delay=0.05)
+        log.append({"name": "Applied", "age": 20})
+        for _ in range(50):
+            if not log.metrics()['pending']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(os.path.getsize(os.path.join(directory, 'writes.log')), 0)
+
+        # Queue three writes behind the emptied log, then let only the first be applied
+        offline.set()
+        log.append({"name": "Applied", "age": 21})
+        queued = {log.append({"name": "Queued", "age": age}) for age in (22, 23)}
+        offline.clear()
+        for _ in range(50):
+            if log.metrics()['applied'] == 2:
+                break
+            time.sleep(0.01)
+        with log.lock:
+            log.file.close()
+
+        replayed = []
+        reopened = WriteBehindLog(directory, replayed.extend, 0.001, 10)
+        self.assertTrue(reopened.start())
+        for _ in range(50):
+            if len(replayed) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual({tracking_id for tracking_id, _ in replayed}, queued)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import unittest
+from app import app, db, Student
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+load_dotenv()
+
+
+@unittest.skipUnless(
+    app.config['DB_TRANSACTION_POOLING'] and os.getenv("PGBOUNCER_DATABASE_URL"),
+    "needs DB_TRANSACTION_POOLING=1 and PGBOUNCER_DATABASE_URL")
+class TestTransactionPooling(unittest.TestCase):
+    """Integration tests run through PgBouncer in transaction pooling mode (make test-pgbouncer)."""
+
+    def setUp(self):
+        """Point the app at PgBouncer and create the tables."""
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("PGBOUNCER_DATABASE_URL")
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+
+        with app.app_context():
+            db.create_all(bind=None)
+
+    def tearDown(self):
+        """Drop the tables."""
+        with app.app_context():
+            db.session.remove()
+            db.drop_all(bind=None)
+
+    def test_no_session_state(self):
+        """Test that no connection is pooled in the app and no statement is prepared."""
+        self.app.post('/students', json={"name": "Ada Lane", "age": 20})
+        self.app.get('/students/1')
+        self.assertFalse(app.config['PREPARED_STATEMENTS'])
+        with app.app_context():
+            self.assertIsInstance(db.engine.pool, NullPool)
+
+        engine = create_engine(os.getenv("PGBOUNCER_DATABASE_URL"), poolclass=NullPool)
+        with engine.connect() as connection:
+            prepared = connection.execute(text("SELECT count(*) FROM pg_prepared_statements"))
+            self.assertEqual(prepared.scalar(), 0)
+
+    def test_concurrent_writes_and_reads(self):
+        """Test that concurrent creates and reads all see consistent data."""
+        statuses = []
+
+        def create_and_read(i):
+            client = app.test_client()
+            created = client.post('/students', json={"name": f"Student {i}", "age": 20})
+            read = client.get(created.headers['Location'])
+            statuses.append((created.status_code, read.json == created.json))
+
+        threads = [threading.Thread(target=create_and_read, args=(i,)) for i in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [(201, True)] * 30)
+        self.assertEqual(len(self.app.get('/students').json), 30)
+
+    def test_guarded_update(self):
+        """Test that an If-Match update and its conflict work across pooled transactions."""
+        created = self.app.post('/students', json={"name": "Bo Marsh", "age": 20})
+        location = created.headers['Location']
+        headers = {'If-Match': self.app.get(location).headers['ETag']}
+        update = {"name": "Bo Marsh", "age": 21}
+
+        self.assertEqual(self.app.put(location, json=update, headers=headers).status_code, 200)
+        self.assertEqual(self.app.put(location, json=update, headers=headers).status_code, 412)
+
+    def test_import_and_stream(self):
+        """Test that the staging table of an import and a streaming cursor stay in one transaction."""
+        body = "name,age\n" + "".join(f"Student {i},{18 + i % 5}\n" for i in range(500))
+        response = self.app.post('/students/import', data=body, content_type='text/csv')
+        self.assertEqual(response.json, {'inserted': 500, 'updated': 0})
+
+        app.config['STUDENTS_STREAM_BATCH_SIZE'] = 100
+        try:
+            response = self.app.get('/students', headers={'Accept': 'application/x-ndjson'})
+        finally:
+            app.config['STUDENTS_STREAM_BATCH_SIZE'] = 1000
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(rows), 500)
+
+        with app.app_context():
+            self.assertEqual(Student.query.count(), 500)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import json
+import os
+import unittest
+from app import app, db, Student, TableVersion, shard_router
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+load_dotenv()
+
+
+@unittest.skipUnless(len(shard_router.shards) >= 2, "needs two or more SHARD_DATABASE_URLS")
+class TestSharding(unittest.TestCase):
+    """Integration tests of the sharded student table (make test-sharding)."""
+
+    def setUp(self):
+        """Create the shard map and the shards, with small id ranges."""
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("TEST_DATABASE_URL")
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        shard_router.range_size = 5
+        shard_router.map_ttl = 0.1
+
+        with app.app_context():
+            db.create_all(bind=None)
+        result = app.test_cli_runner().invoke(args=["shards", "init"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def tearDown(self):
+        """Drop the shards and the shard map."""
+        with app.app_context():
+            db.session.remove()
+            for shard in shard_router.shards:
+                db.Model.metadata.drop_all(db.get_engine(app, bind=shard),
+                                           tables=[Student.__table__, TableVersion.__table__])
+            db.drop_all(bind=None)
+        shard_router.loaded_at = None
+
+    def stored_on(self, shard):
+        """Ids of the students stored on a shard."""
+        with app.app_context(), db.get_engine(app, bind=shard).connect() as connection:
+            return set(connection.execute(select(Student.id)).scalars())
+
+    def create(self, count):
+        """Create students, with names whose order depends on the collation, and return them."""
+        names = ("ada", "Bea", "\u00e9mile", "Zo\u00eb", "_x")
+        return [self.app.post('/students', json={"name": f"{names[i % 5]} {i:02}",
+                                                 "age": 18 + i % 4}).json
+                for i in range(count)]
+
+    def test_ids_follow_shard_ranges(self):
+        """Test that every new student is stored on the shard that owns its id."""
+        created = self.create(24)
+        self.assertEqual(len({s['id'] for s in created}), 24)
+        for shard in shard_router.shards:
+            stored = self.stored_on(shard)
+            self.assertTrue(stored)
+            self.assertTrue(all(shard_router.shard_for(i) == shard for i in stored))
+        # Every shard used up its first range and leased more
+        self.assertGreater(len(shard_router.current_map(refresh=True)), len(shard_router.shards))
+
+        student = created[7]
+        response = self.app.get(f"/students/{student['id']}")
+        self.assertEqual(response.json, student)
+        response = self.app.patch(f"/students/{student['id']}", json={"age": 40},
+                                  headers={'If-Match': response.headers['ETag']})
+        self.assertEqual(response.json['age'], 40)
+        self.assertEqual(self.app.get('/students/999999').status_code, 404)
+
+    def test_listing_merges_shards(self):
+        """Test that pages and streams of all shards come back in keyset order."""
+        created = self.create(20)
+        for sort, key in (("id", lambda s: s['id']),
+                          ("-age", lambda s: (-s['age'], -s['id'])),
+                          ("name", lambda s: (s['name'], s['id']))):
+            listed, url = [], f'/students?limit=3&sort={sort}'
+            while url:
+                response = self.app.get(url)
+                listed.extend(response.json)
+                url = response.headers.get('Link', '')[1:].partition('>')[0]
+            self.assertEqual(listed, sorted(created, key=key), sort)
+
+        response = self.app.get('/students?age=19', headers={'Accept': 'application/x-ndjson'})
+        streamed = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(streamed, [s for s in created if s['age'] == 19])
+
+    def test_move_range(self):
+        """Test that a range moves with its rows and stays readable and writable."""
+        created = self.create(24)
+        low, high, source = shard_router.current_map(refresh=True)[0]
+        target = next(shard for shard in shard_router.shards if shard != source)
+        moved = [s for s in created if low <= s['id'] < high]
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["shards", "move", str(low), str(high - 1), target,
+                                     "--batch-size", "2"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"Moved {len(moved)} students", result.output)
+
+        self.assertFalse(self.stored_on(source) & {s['id'] for s in moved})
+        self.assertLessEqual({s['id'] for s in moved}, self.stored_on(target))
+        self.assertEqual(self.app.get('/students?limit=100').json,
+                         sorted(created, key=lambda s: s['id']))
+        response = self.app.put(f"/students/{moved[0]['id']}", json={"name": "Moved", "age": 30},
+                                headers={'If-Match': f"\"v{moved[0]['version']}\""})
+        self.assertEqual(response.status_code, 200)
+
+        # The range a shard is still handing out ids from cannot be moved
+        low, high, source = shard_router.current_map()[-1]
+        result = runner.invoke(args=["shards", "move", str(low), str(high - 1), target])
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_unsupported_routes(self):
+        """Test that routes that cannot run across shards yet are refused."""
+        response = self.app.post('/students/bulk', json=[{"name": "Ada Lane", "age": 20}])
+        self.assertEqual(response.status_code, 501)
+        response = self.app.post('/students', json={"name": "Ada Lane", "age": 20},
+                                 headers={'Idempotency-Key': 'k1'})
+        self.assertEqual(response.status_code, 501)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+This module classifies transient database errors and paces retries of them.
+
+A transient error is one that a later attempt of the same unit of work can be
+expected to get past: the connection was lost (a failover or restart), or
+Postgres aborted the transaction because of a serialization failure or a
+deadlock. Retries wait a capped, fully jittered exponential backoff, so that
+clients failing together do not come back together.
+"""
+
+import random
+import threading
+
+import psycopg2
+from sqlalchemy.exc import DBAPIError
+
+# pylint: disable=no-member
+# Transaction aborted and rolled back by Postgres, nothing was written
+ABORTED = (
+    (psycopg2.errors.SerializationFailure, "serialization_failure"),
+    (psycopg2.errors.DeadlockDetected, "deadlock"),
+)
+# Server shutting down, crashed or still starting up
+SHUTDOWN = (psycopg2.errors.AdminShutdown, psycopg2.errors.CrashShutdown,
+            psycopg2.errors.CannotConnectNow)
+
+KINDS = ("connection", "serialization_failure", "deadlock")
+OUTCOMES = ("retried", "recovered", "given_up")
+
+
+def classify(exc):
+    """
+    Return the kind of transient error exc is, or None if it is not transient.
+
+    Kinds are "connection", "serialization_failure" and "deadlock".
+    """
+    if isinstance(exc, DBAPIError) and exc.connection_invalidated:
+        return "connection"
+    orig = getattr(exc, "orig", exc)
+    for error, kind in ABORTED:
+        if isinstance(orig, error):
+            return kind
+    if isinstance(orig, SHUTDOWN) or (getattr(orig, "pgcode", None) or "").startswith("08"):
+        return "connection"
+    # libpq raises the bare class for connections that were refused or dropped
+    if type(orig) is psycopg2.OperationalError:  # pylint: disable=unidiomatic-typecheck
+        return "connection"
+    return None
+
+
+class RetryPolicy:
+    """
+    How often and how patiently to retry transient errors, with retry metrics.
+
+    attempts counts the first try. The n-th retry waits a random time between 0
+    and min(max_delay, base_delay * 2 ** n) seconds.
+    """
+    def __init__(self, attempts, base_delay, max_delay):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.stats = {kind: dict.fromkeys(OUTCOMES, 0) for kind in KINDS}
+        self.slept = 0.0
+
+    def delay(self, retry):
+        """
+        Backoff before the given retry, counted from 0.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def record(self, kind, outcome, slept=0.0):
+        """
+        Count a retry, a success after retrying, or giving up on a kind of error.
+        """
+        with self.lock:
+            self.stats[kind][outcome] += 1
+            self.slept += slept
+
+    def metrics(self):
+        """
+        Return retry counts per kind of error as a dict.
+        """
+        with self.lock:
+            return {
+                **{kind: dict(counts) for kind, counts in self.stats.items()},
+                "backoff_seconds": self.slept,
+                "max_attempts": self.attempts,
+            }
@@ -0,0 +1,209 @@
+"""
+This module is a write-behind queue backed by a durable local append-only log.
+
+Accepted writes are appended to the log and acknowledged once an fsync covers
+them; one fsync is shared by every append that arrived while it was pending.
+A drainer thread applies the log to the database in batches and records how far
+it got in a checkpoint file, so a restarted process replays whatever had been
+accepted but not applied yet. Because a crash can land between applying a batch
+and checkpointing it, apply must be idempotent per tracking id.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+LOG_NAME = "writes.log"
+CHECKPOINT_NAME = "checkpoint"
+
+
+class WriteBehindLog:
+    """
+    Durable queue of writes applied in the background by apply.
+
+    apply receives a list of (tracking id, item) pairs in log order. If it raises,
+    the batch is retried after retry_delay seconds.
+    """
+    def __init__(self, directory, apply, fsync_interval, batch_size, retry_delay=1.0):
+        self.apply = apply
+        self.options = {"directory": directory, "fsync_interval": fsync_interval,
+                        "batch_size": batch_size, "retry_delay": retry_delay}
+        self.lock = threading.Condition()
+        self.file = None
+        # Appended but not yet fsynced, and fsynced but not yet applied, in log order
+        self.unsynced = []
+        self.pending = {}
+        # locked_out counts the starts refused because another process owns the log
+        self.counters = {"appended": 0, "synced": 0, "applied": 0, "locked_out": 0}
+
+    def start(self):
+        """
+        Open the log, replay unapplied writes and start the background threads.
+
+        Returns False, without starting, while another process owns the log.
+        """
+        with self.lock:
+            if self.file is not None:
+                return True
+            directory = self.options["directory"]
+            os.makedirs(directory, exist_ok=True)
+            log = open(os.path.join(directory, LOG_NAME), "a+b")  # pylint: disable=consider-using-with
+            # One process owns a log; a second one would apply its writes twice
+            try:
+                fcntl.flock(log, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.close()
+                if not self.counters["locked_out"]:
+                    logger.warning("Write-behind log in %s is owned by another process",
+                                   directory)
+                self.counters["locked_out"] += 1
+                return False
+            self.file = log
+            self.replay()
+        threading.Thread(target=self.sync_forever, name="write-behind-sync", daemon=True).start()
+        threading.Thread(target=self.drain_forever, name="write-behind-drain",
+                         daemon=True).start()
+        return True
+
+    def replay(self):
+        """
+        Load the records after the checkpoint into the pending queue.
+        """
+        path = os.path.join(self.options["directory"], CHECKPOINT_NAME)
+        try:
+            with open(path, encoding="ascii") as f:
+                offset = int(f.read() or 0)
+        except FileNotFoundError:
+            offset = 0
+        # The log may have been emptied after the checkpoint was last written
+        size = os.fstat(self.file.fileno()).st_size
+        offset = min(offset, size)
+        self.file.seek(offset)
+        end = offset
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            record = json.loads(line)
+            self.pending[record["id"]] = (record["item"], end)
+        # Drop a record torn by a crash in the middle of an append
+        if end < size:
+            self.file.truncate(end)
+            self.file.seek(end)
+        if self.pending:
+            logger.info("Replaying %d unapplied writes", len(self.pending))
+
+    def append(self, item):
+        """
+        Durably queue an item and return its tracking id.
+
+        Raises RuntimeError when another process owns the log.
+        """
+        if not self.start():
+            raise RuntimeError("The write-behind log is owned by another process")
+        tracking_id = f"{int(time.time()):x}-{uuid.uuid4().hex}"
+        line = json.dumps({"id": tracking_id, "item": item}, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line.encode())
+            self.counters["appended"] += 1
+            sequence = self.counters["appended"]
+            self.unsynced.append((tracking_id, item, self.file.tell()))
+            self.lock.notify_all()
+            while self.counters["synced"] < sequence:
+                self.lock.wait()
+        return tracking_id
+
+    @staticmethod
+    def issued_at(tracking_id):
+        """
+        Unix time at which a tracking id was handed out, or None if it is malformed.
+        """
+        issued, _, rest = tracking_id.partition("-")
+        try:
+            uuid.UUID(hex=rest)
+            return int(issued, 16)
+        except ValueError:
+            return None
+
+    def is_pending(self, tracking_id):
+        """
+        Whether the write is queued but not applied yet.
+        """
+        with self.lock:
+            return tracking_id in self.pending or any(
+                tracking_id == record[0] for record in self.unsynced)
+
+    def sync_forever(self):
+        """
+        Fsync new appends, sharing each fsync between all of them.
+        """
+        while True:
+            with self.lock:
+                while self.counters["synced"] == self.counters["appended"]:
+                    self.lock.wait()
+            # Give concurrent appends a moment to join this fsync
+            time.sleep(self.options["fsync_interval"])
+            with self.lock:
+                self.file.flush()
+                target = self.counters["appended"]
+                batch, self.unsynced = self.unsynced, []
+            os.fsync(self.file.fileno())
+            with self.lock:
+                self.counters["synced"] = target
+                for tracking_id, item, end in batch:
+                    self.pending[tracking_id] = (item, end)
+                self.lock.notify_all()
+
+    def drain_forever(self):
+        """
+        Apply pending writes in batches and checkpoint after each one.
+        """
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                batch = list(islice(self.pending.items(), self.options["batch_size"]))
+            try:
+                self.apply([(tracking_id, item) for tracking_id, (item, _) in batch])
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Applying %d queued writes failed, retrying", len(batch))
+                time.sleep(self.options["retry_delay"])
+                continue
+            with self.lock:
+                for tracking_id, _ in batch:
+                    del self.pending[tracking_id]
+                self.counters["applied"] += len(batch)
+                self.checkpoint(batch[-1][1][1])
+
+    def checkpoint(self, offset):
+        """
+        Record that the log is applied up to offset, truncating it once fully applied.
+
+        Must be called with the lock held.
+        """
+        if not self.pending and self.counters["synced"] == self.counters["appended"]:
+            self.file.flush()
+            self.file.truncate(0)
+            # truncate leaves the position alone, and append reads end offsets from tell
+            self.file.seek(0)
+            offset = 0
+        path = os.path.join(self.options["directory"], CHECKPOINT_NAME)
+        with open(path + ".tmp", "w", encoding="ascii") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def metrics(self):
+        """
+        Return queue metrics as a dict.
+        """
+        with self.lock:
+            return dict(self.counters, pending=len(self.pending) + len(self.unsynced))